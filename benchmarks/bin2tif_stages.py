@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+'''
+Time the bin2tif hot path stage by stage on synthetic production-size
+captures, with the peak resident memory of each stage.
+
+Every stage runs in its own child process, so the peak RSS reported for it
+(ru_maxrss growth over the child's starting footprint) is not hidden by an
+earlier, larger stage. Results can be written as JSON and compared against a
+previous run with --baseline; the exit status is 1 if any stage got slower
+than --tolerance allows.
+----------------------------------------------------------------------------------------
+Usage:
+python bin2tif_stages.py -o /tmp/bin2tif_bench --repeat 5 --json new.json --baseline old.json
+'''
+
+import os, sys, time, json, argparse, platform, resource, shutil, multiprocessing
+from glob import glob
+import numpy as np
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin2tif'))
+import bin_to_geotiff
+import bayer
+import fixtures
+
+STAGES = ['read_frame', 'demosaic', 'process_image', 'create_geotiff', 'create_geotiff_tiled_deflate',
+          'create_geotiff_from_bin', 'convert_captures']
+# Seconds between checks that a stage child is still alive
+POLL_S = 5
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='Per-stage timings and peak RSS of the bin2tif pipeline',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-o", "--out_dir", help="scratch directory for fixtures and outputs")
+    parser.add_argument("--stages", default=','.join(STAGES), help="comma-separated stages to run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    parser.add_argument("--width", type=int, default=fixtures.FRAME_SHAPE[0], help="frame width")
+    parser.add_argument("--height", type=int, default=fixtures.FRAME_SHAPE[1], help="frame height")
+    parser.add_argument("--json", help="optional file to write results to")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional slowdown of a stage's best time before it counts as a regression")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds a stage may run before it is killed")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        fail('Unknown stages: ' + ', '.join(sorted(unknown)))
+        sys.exit(2)
+
+    shape = (args.width, args.height)
+    capture_dir = os.path.join(args.out_dir, 'capture')
+    if os.path.exists(args.out_dir):
+        shutil.rmtree(args.out_dir)
+    # Generate the fixtures in a child too; forked children inherit the parent's peak RSS
+    writer = multiprocessing.Process(target=fixtures.write_capture, args=(capture_dir,), kwargs={"shape": shape})
+    writer.start()
+    writer.join()
+    left_bin = glob(os.path.join(capture_dir, '*_left.bin'))[0]
+    fixture = {"out_dir": args.out_dir, "capture_dir": capture_dir, "bin": left_bin, "shape": shape}
+
+    results = {"frame_shape": list(shape), "repeat": args.repeat, "environment": environment(), "stages": {}}
+    failed = []
+    for stage in stages:
+        stats = run_isolated(stage, fixture, args.repeat, args.timeout)
+        results["stages"][stage] = stats
+        if "error" in stats:
+            failed.append(stage)
+            print("%-30s FAILED: %s" % (stage, stats["error"]))
+            continue
+        print("%-30s best %8.3fs  median %8.3fs  peak rss +%8.1f MB" % (stage, stats["best_s"], stats["median_s"],
+                                                                        stats["peak_rss_delta_mb"]))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        regressions = compare(load_results(args.baseline), results, args.tolerance)
+        for stage, old, new in regressions:
+            print("REGRESSION %-30s %8.3fs -> %8.3fs" % (stage, old, new))
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+    return results
+
+def run_isolated(stage, fixture, repeat, timeout=None):
+    # Fork a child per stage so ru_maxrss only covers that stage; a child that
+    # dies without reporting (segfault, OOM kill) or overruns timeout fails the stage
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=stage_worker, args=(queue, stage, fixture, repeat))
+    child.start()
+    start = time.time()
+    stats = None
+    while stats is None:
+        try:
+            stats = queue.get(timeout=POLL_S)
+        except Empty:
+            if not child.is_alive():
+                # the result may have been queued just before the child exited
+                try:
+                    stats = queue.get(timeout=1)
+                except Empty:
+                    stats = {"error": "child exited with code %s without a result" % child.exitcode}
+            elif timeout and time.time() - start > timeout:
+                child.terminate()
+                stats = {"error": "timed out after %ds" % timeout}
+    child.join()
+    return stats
+
+def stage_worker(queue, stage, fixture, repeat):
+    try:
+        run = prepare(stage, fixture)
+        start_rss = max_rss_mb()
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        peak_rss = max_rss_mb()
+        queue.put({"times_s": times, "best_s": min(times), "median_s": float(np.median(times)),
+                   "peak_rss_mb": peak_rss, "peak_rss_delta_mb": peak_rss - start_rss})
+    except Exception as ex:
+        queue.put({"error": str(ex)})
+
+def prepare(stage, fixture):
+    """Set up the inputs of a stage outside the timed region and return its callable."""
+    shape, in_bin = fixture["shape"], fixture["bin"]
+    out_dir = os.path.join(fixture["out_dir"], stage)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_tif = os.path.join(out_dir, 'out.tif')
+    bounds = fixtures.capture_bounds(0)
+
+    if stage == 'read_frame':
+        return lambda: np.array(bayer.read_frame(in_bin, shape))
+    if stage == 'demosaic':
+        return lambda: bayer.demosaic_rot90(bayer.read_frame(in_bin, shape))
+    if stage == 'process_image':
+        return lambda: bin_to_geotiff.process_image(shape, in_bin, os.path.join(out_dir, 'out.jpg'))
+    if stage in ('create_geotiff', 'create_geotiff_tiled_deflate'):
+        image = bayer.demosaic_rot90(bayer.read_frame(in_bin, shape))
+        opts = None
+        if stage == 'create_geotiff_tiled_deflate':
+            opts = bin_to_geotiff.geotiff_options(compress='DEFLATE', predictor=2)
+        return lambda: bin_to_geotiff.create_geotiff('left', image, bounds, out_tif, opts)
+    if stage == 'create_geotiff_from_bin':
+        return lambda: bin_to_geotiff.create_geotiff_from_bin('left', in_bin, shape, bounds, out_tif)
+    if stage == 'convert_captures':
+        return lambda: bin_to_geotiff.convert_captures(fixture["capture_dir"], out_dir, bounds)
+
+def compare(baseline, results, tolerance):
+    # Stages whose best time grew by more than tolerance over the baseline
+    regressions = []
+    for stage, stats in sorted(results["stages"].items()):
+        old = baseline.get("stages", {}).get(stage)
+        if "error" in stats or not old or "error" in old:
+            continue
+        if stats["best_s"] > old["best_s"]*(1 + tolerance):
+            regressions.append((stage, old["best_s"], stats["best_s"]))
+    return regressions
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024.0**2 if sys.platform == 'darwin' else rss/1024.0
+
+def environment():
+    env = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+           "cpus": multiprocessing.cpu_count()}
+    try:
+        env["gdal"] = bin_to_geotiff.gdal.__version__
+    except AttributeError:
+        pass
+    return env
+
+def fail(reason):
+    print >> sys.stderr, reason
+
+if __name__ == '__main__':
+
+    main()
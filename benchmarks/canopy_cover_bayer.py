@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''
+Validate and time the Bayer-domain canopy cover (canopyCover.gen_cc_for_bayer)
+against the demosaic + gen_cc_for_img path on the same frames.
+
+Frames are synthetic fixtures at several canopy fractions, or real raw
+left/right .bin files passed with --bins. The difference is reported in
+percentage points of cover.
+----------------------------------------------------------------------------------------
+Usage:
+python canopy_cover_bayer.py --canopy 0.05,0.3,0.6 --seeds 3 --json cc.json
+python canopy_cover_bayer.py --bins /data/2017-06-01/*/*_left.bin
+'''
+
+import os, sys, time, json, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'canopycover'))
+import canopyCover
+import bayer
+import fixtures
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='Bayer-domain vs RGB canopy cover',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--bins", nargs='*', default=[], help="raw 3296x2472 BayerGR8 frames to use instead of fixtures")
+    parser.add_argument("--canopy", default='0.05,0.3,0.6', help="canopy fractions of the synthetic frames")
+    parser.add_argument("--seeds", type=int, default=2, help="synthetic frames per canopy fraction")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+
+    if args.bins:
+        frames = [(path, bayer.read_frame(path, fixtures.FRAME_SHAPE)) for path in args.bins]
+    else:
+        frames = [('synthetic canopy=%s seed=%d' % (canopy, seed),
+                   fixtures.synthetic_bayer(seed=seed, canopy=float(canopy)))
+                  for canopy in args.canopy.split(',') for seed in range(args.seeds)]
+
+    rows = []
+    for name, raw in frames:
+        start = time.time()
+        rgb_cc = canopyCover.gen_cc_for_img(bayer.demosaic_rot90(raw), 5)
+        rgb_s = time.time() - start
+
+        start = time.time()
+        bayer_cc = canopyCover.gen_cc_for_bayer(raw, 5)
+        bayer_s = time.time() - start
+
+        rows.append({"frame": name, "rgb_cc": rgb_cc, "bayer_cc": bayer_cc,
+                     "diff_pct_points": 100*(bayer_cc - rgb_cc), "rgb_s": rgb_s, "bayer_s": bayer_s})
+        print("%-40s rgb %6.2f%%  bayer %6.2f%%  diff %+5.2f  speedup %5.1fx" % (
+            name[-40:], 100*rgb_cc, 100*bayer_cc, 100*(bayer_cc - rgb_cc), rgb_s/bayer_s))
+
+    results = {"frames": rows,
+               "max_abs_diff_pct_points": max(abs(r["diff_pct_points"]) for r in rows),
+               "speedup": sum(r["rgb_s"] for r in rows)/sum(r["bayer_s"] for r in rows)}
+    print("max |diff| %.2f percentage points, overall speedup %.1fx" % (results["max_abs_diff_pct_points"],
+                                                                       results["speedup"]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+if __name__ == '__main__':
+
+    main()
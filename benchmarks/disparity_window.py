@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+Compare the full SGBM disparity search of the height recovery (minDisparity
+1, 320 levels) with the adaptive window of disparity.disparity_window on a
+synthetic rectified pair: matching time, and the 8 mm height histograms of
+the kept disparities (132 < d < 320), as export_height_data_to_file builds
+them.
+
+The scene is soil at --soil-disp px with canopy up to --canopy-disp px
+closer; the camera height follows from the soil disparity and the quarter
+resolution focal length. Histograms are compared over the columns the full
+search can match (x >= 321), and the adaptive search's extra matched
+columns at the left edge are counted separately.
+----------------------------------------------------------------------------------------
+Usage:
+python disparity_window.py --ranges 0,3200 0,1500 --repeat 3 --json window.json
+'''
+
+import sys, os, time, json, argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'height_recovery'))
+import disparity
+from sgbm_strips import synthetic_pair, timed
+
+# Quarter resolution focal length (Q[2][3] / 4) and baseline of generate_height_hist
+FOCAL_LENGTH = 6761/4.0
+BASELINE = 217.3468
+BIN_MM, BINS = 8, 400
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='full vs adaptive SGBM disparity search',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--size", default='824x618', help="rectified pair size, WIDTHxHEIGHT")
+    parser.add_argument("--soil-disp", type=float, default=150.0, help="disparity of the soil, px")
+    parser.add_argument("--canopy-disp", type=float, default=90.0, help="extra disparity of the canopy top, px")
+    parser.add_argument("--ranges", nargs='+', default=['0,3200', '0,1500'], help="plant height ranges in mm, min,max")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per setting; the best is reported")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    imgL, imgR, truth = synthetic_pair([int(v) for v in args.size.split('x')], soil_disp=args.soil_disp,
+                                       canopy_disp=args.canopy_disp)
+    camera_height = FOCAL_LENGTH*BASELINE/args.soil_disp
+    print("camera %.0f mm above the soil, canopy up to %.0f mm" % (
+        camera_height, camera_height - FOCAL_LENGTH*BASELINE/(args.soil_disp + args.canopy_disp)))
+
+    full_s = min(timed(disparity.compute_disparity, imgL, imgR, 1, 320) for _ in range(args.repeat))
+    full = disparity.compute_disparity(imgL, imgR, 1, 320)
+    full_hist = height_hist(full, camera_height, 321)
+    results = {"camera_height_mm": camera_height, "full_s": full_s, "full_wrong": wrong(full, truth), "ranges": []}
+    print("full        (  1, 320) %7.3fs  %.2f%% of kept pixels off the truth by > 1 px" % (
+        full_s, 100*results["full_wrong"]))
+
+    for text in args.ranges:
+        height_range = tuple(float(v) for v in text.split(','))
+        min_disp, num_disp = disparity.disparity_window(camera_height, FOCAL_LENGTH, BASELINE, height_range)
+        seconds = min(timed(disparity.compute_disparity, imgL, imgR, min_disp, num_disp) for _ in range(args.repeat))
+        disp = disparity.compute_disparity(imgL, imgR, min_disp, num_disp)
+        hist = height_hist(disp, camera_height, 321)
+        extra = height_hist(disp[:, :321], camera_height, 0).sum()
+        run = {"height_range": height_range, "min_disp": min_disp, "num_disp": num_disp, "seconds": seconds,
+               "speedup": full_s/seconds,
+               # share of histogram counts that move bins or appear/disappear, over the common columns
+               "hist_l1": float(np.abs(hist - full_hist).sum()/max(full_hist.sum(), 1)),
+               "kept_full": int(full_hist.sum()), "kept": int(hist.sum()), "extra_left_edge": int(extra),
+               "wrong": wrong(disp, truth)}
+        results["ranges"].append(run)
+        print("%-11s (%3d, %3d) %7.3fs  %.1fx  %.2f%% off the truth, histogram L1 %.4f, kept %d vs %d, "
+              "+%d at the left edge" % (text, min_disp, num_disp, seconds, run["speedup"], 100*run["wrong"],
+                                        run["hist_l1"], run["kept"], run["kept_full"], extra))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def wrong(disp, truth):
+    # share of kept disparities right of the full search's blind columns more than 1 px from the truth
+    disp, truth = disp[:, 321:], truth[:, 321:]
+    kept = (disp > disparity.KEEP_DISP[0]) & (disp < disparity.KEEP_DISP[1])
+    return float((np.abs(disp - truth)[kept] > 1).mean())
+
+def height_hist(disp, camera_height, first_col):
+    # 8 mm height histogram of the kept disparities right of first_col, open bins as in plot_height_hists
+    disp = disp[:, first_col:]
+    kept = disp[(disp > disparity.KEEP_DISP[0]) & (disp < disparity.KEEP_DISP[1])]
+    heights = camera_height - FOCAL_LENGTH*BASELINE/kept
+    bins = np.floor_divide(heights, BIN_MM)
+    valid = (heights > 0) & (heights < BINS*BIN_MM) & (bins*BIN_MM != heights)
+    return np.bincount(bins[valid].astype(np.int64), minlength=BINS)
+
+if __name__ == '__main__':
+
+    main()
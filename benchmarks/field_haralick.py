@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+'''
+Time the Haralick features of every plot of a synthetic field computed plot by
+plot (crop, quantise and gift_features.glcm per plot, as feature_table does)
+against the one-pass field engine (quantise once, gift_features.glcm_counts
+over the field label image in row blocks, as field_texture.haralick_by_plot
+does), and check that both give the same features.
+
+The field is a grid of --rows x --cols rectangular plots of synthetic scene;
+the raster read and polygon rasterization of field_texture are not included.
+----------------------------------------------------------------------------------------
+Usage:
+python field_haralick.py --rows 16 --cols 32 --plot 120x40 --json haralick.json
+'''
+
+import sys, os, time, json, argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo-texture-analysis'))
+import gift_features
+import fixtures
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='per-plot vs one-pass field Haralick features',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--rows", type=int, default=16, help="plot rows in the field")
+    parser.add_argument("--cols", type=int, default=32, help="plot columns in the field")
+    parser.add_argument("--plot", default='120x40', help="plot size in pixels, WIDTHxHEIGHT")
+    parser.add_argument("--gap", type=int, default=4, help="pixels between plots")
+    parser.add_argument("--block-rows", type=int, default=1024, help="rows per block of the one-pass engine")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    width, height = [int(v) for v in args.plot.split('x')]
+    rgb, labels, boxes = synthetic_field(args.rows, args.cols, width, height, args.gap)
+    scales = gift_features.HARALICK_SCALES
+    print("field %dx%d, %d plots" % (rgb.shape[1], rgb.shape[0], len(boxes)))
+
+    start = time.time()
+    per_plot = per_plot_features(rgb, boxes, scales)
+    per_plot_s = time.time() - start
+
+    start = time.time()
+    one_pass = one_pass_features(rgb, labels, len(boxes), scales, args.block_rows)
+    one_pass_s = time.time() - start
+
+    results = {"plots": len(boxes), "per_plot_s": per_plot_s, "one_pass_s": one_pass_s,
+               "max_abs_diff": float(np.abs(per_plot - one_pass).max())}
+    print("per plot  %8.3fs  (%.2f ms/plot)" % (per_plot_s, 1000*per_plot_s/len(boxes)))
+    print("one pass  %8.3fs  (%.2f ms/plot), %.1fx faster" % (one_pass_s, 1000*one_pass_s/len(boxes),
+                                                              per_plot_s/one_pass_s))
+    print("max abs difference %g" % results["max_abs_diff"])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def synthetic_field(rows, cols, width, height, gap):
+    # Plot boxes (top, left) start on even pixels, so every-2nd-pixel subsampling
+    # of a plot's crop and of the field pick the same pixels
+    gap += gap % 2
+    width, height = width + width % 2, height + height % 2
+    shape = (rows*(height + gap) + gap, cols*(width + gap) + gap)
+    rgb = fixtures.synthetic_scene((shape[1], shape[0]), seed=0)
+    labels = np.zeros(shape, dtype=np.int32)
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            top, left = gap + r*(height + gap), gap + c*(width + gap)
+            labels[top:top+height, left:left+width] = len(boxes) + 1
+            boxes.append((top, left, height, width))
+    return rgb, labels, boxes
+
+def per_plot_features(rgb, boxes, scales):
+    values = []
+    for top, left, height, width in boxes:
+        crop = rgb[top:top+height, left:left+width]
+        roi = np.ones((height, width), dtype=np.int32)
+        d = gift_features.dgci(crop)
+        values.append(np.hstack([gift_features.haralick_features(gift_features.glcm(roi, d, scale=s, nlabels=1))[0]
+                                 for s in scales]))
+    return np.array(values)
+
+def one_pass_features(rgb, labels, nlabels, scales, block_rows):
+    # field_texture.haralick_by_plot without the raster read and rasterization
+    nbins = gift_features.HARALICK_NBINS
+    step = int(np.prod(scales))
+    block_rows = max(step, block_rows//step*step)
+    counts = dict((s, np.zeros((nlabels, nbins, nbins), dtype=np.int64)) for s in scales)
+    for top in range(0, labels.shape[0], block_rows):
+        bottom = min(top + block_rows, labels.shape[0])
+        read_top = max(top - max(scales), 0)
+        levels = gift_features.quantise(gift_features.dgci(rgb[read_top:bottom]))
+        block = labels[read_top:bottom]
+        for s in scales:
+            first = top - s - read_top if top > 0 else 0
+            counts[s] += gift_features.glcm_counts(block[first::s, ::s], levels[first::s, ::s], nlabels, nbins,
+                                                   halo=top > 0)
+    return np.hstack([gift_features.haralick_features(gift_features.normalise_glcm(counts[s])) for s in scales])
+
+if __name__ == '__main__':
+
+    main()
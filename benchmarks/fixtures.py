@@ -0,0 +1,116 @@
+'''
+Synthetic stereoTop captures for the benchmarks: raw BayerGR8 .bin frames at
+production size and the matching cleaned metadata JSON, laid out like a
+Level_0 capture directory (<timestamp>_left.bin, <timestamp>_right.bin,
+<timestamp>_metadata.json).
+'''
+
+import os, json
+import numpy as np
+
+# Production stereoTop frame, (width, height) as in the capture metadata
+FRAME_SHAPE = (3296, 2472)
+# Approximate footprint of one capture in decimal degrees (lng, lat)
+CAPTURE_SIZE = (0.0000110, 0.0000150)
+ORIGIN = (33.0745, -111.9750)
+
+SOIL_RGB = (120, 100, 80)
+PLANT_RGB = (60, 140, 50)
+
+
+def synthetic_scene(shape=FRAME_SHAPE, seed=0, canopy=0.3):
+    """
+    Soil with patches of green canopy covering roughly the given fraction,
+    plus sensor noise, as an (height, width, 3) uint8 RGB image.
+    """
+    width, height = shape
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    phase = rng.uniform(0, 2*np.pi, 4)
+    field = (np.sin(xx/83.0 + phase[0])*np.cos(yy/57.0 + phase[1]) +
+             0.5*np.sin(xx/29.0 + phase[2])*np.sin(yy/41.0 + phase[3]))
+    plant = field > np.percentile(field, 100*(1 - canopy))
+
+    scene = np.empty((height, width, 3), dtype=np.uint8)
+    for channel in range(3):
+        base = np.where(plant, PLANT_RGB[channel], SOIL_RGB[channel]).astype(np.float32)
+        scene[:, :, channel] = np.clip(base + rng.normal(0, 10, base.shape), 0, 255)
+    return scene
+
+
+def mosaic(scene):
+    # Sample an RGB scene through the GT3300C G R / B G filter array
+    raw = np.empty(scene.shape[:2], dtype=np.uint8)
+    raw[0::2, 0::2] = scene[0::2, 0::2, 1]
+    raw[0::2, 1::2] = scene[0::2, 1::2, 0]
+    raw[1::2, 0::2] = scene[1::2, 0::2, 2]
+    raw[1::2, 1::2] = scene[1::2, 1::2, 1]
+    return raw
+
+
+def synthetic_bayer(shape=FRAME_SHAPE, seed=0, canopy=0.3):
+    """Raw (height, width) BayerGR8 frame of a synthetic_scene."""
+    return mosaic(synthetic_scene(shape, seed, canopy))
+
+
+def capture_bounds(index, grid=8):
+    # (lat_min, lat_max, lng_min, lng_max) of capture index on a grid x grid layout
+    row, col = divmod(index, grid)
+    lat_min = ORIGIN[0] + row*CAPTURE_SIZE[1]
+    lng_min = ORIGIN[1] + col*CAPTURE_SIZE[0]
+    return (lat_min, lat_min+CAPTURE_SIZE[1], lng_min, lng_min+CAPTURE_SIZE[0])
+
+
+def bounding_box_geojson(bounds):
+    lat_min, lat_max, lng_min, lng_max = bounds
+    return {"type": "Polygon",
+            "coordinates": [[[lng_min, lat_max], [lng_max, lat_max], [lng_max, lat_min],
+                             [lng_min, lat_min], [lng_min, lat_max]]]}
+
+
+def stereo_metadata(timestamp, shape=FRAME_SHAPE, position=(50.0, 10.0, 2.5), bounds=None):
+    """Cleaned stereoTop metadata as read by bin_to_geotiff and the extractors."""
+    width, height = shape
+    bounds = bounds or capture_bounds(0)
+    return {
+        "gantry_variable_metadata": {
+            "datetime": timestamp,
+            "position_m": {"x": position[0], "y": position[1], "z": position[2]}
+        },
+        "sensor_fixed_metadata": {
+            "sensor_id": "stereoTop",
+            "url": "https://terraref.ncsa.illinois.edu/clowder/sensors/stereoTop",
+            "location_in_camera_box_m": {"x": 0.877, "y": 0.0, "z": 0.578},
+            "field_of_view_at_2m_m": {"x": 1.015, "y": 0.749}
+        },
+        "sensor_variable_metadata": {
+            "image_format": {"left": "BayerGR8", "right": "BayerGR8"},
+            "width_image_pixels": {"left": str(width), "right": str(width)},
+            "height_image_pixels": {"left": str(height), "right": str(height)}
+        },
+        "experiment_metadata": [{"name": "Synthetic benchmark"}],
+        "spatial_metadata": {
+            "left": {"bounding_box": bounding_box_geojson(bounds)},
+            "right": {"bounding_box": bounding_box_geojson(bounds)}
+        }
+    }
+
+
+def write_capture(out_dir, timestamp='2017-06-01__12-00-00-000', shape=FRAME_SHAPE, seed=0, bounds=None):
+    """
+    Write a left/right .bin pair and metadata JSON to out_dir.
+
+    Returns (metadata path, left .bin path, right .bin path).
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    meta_path = os.path.join(out_dir, timestamp + '_metadata.json')
+    with open(meta_path, 'w') as f:
+        json.dump(stereo_metadata(timestamp, shape, bounds=bounds), f, indent=2)
+
+    paths = [meta_path]
+    for offset, side in enumerate(('left', 'right')):
+        bin_path = os.path.join(out_dir, '%s_%s.bin' % (timestamp, side))
+        synthetic_bayer(shape, seed + offset).tofile(bin_path)
+        paths.append(bin_path)
+    return tuple(paths)
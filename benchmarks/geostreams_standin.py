@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+'''
+Local stand-in for the Clowder geostreams API, for measuring datapoint
+submission throughput offline.
+
+It keeps sensors, streams and datapoints in memory and answers the requests
+terrautils.geostreams and geostreams_batch make: GET/POST
+api/geostreams/sensors and api/geostreams/streams (GET filtered by
+sensor_name/stream_name), POST api/geostreams/datapoints and
+api/geostreams/datapoints/bulk. Every request is delayed by --latency
+milliseconds to stand in for the network round trip and server work.
+----------------------------------------------------------------------------------------
+Usage:
+python geostreams_standin.py --port 9000 --latency 20
+(then use http://localhost:9000/ as the Clowder host)
+'''
+
+import sys, json, time, argparse, threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='In-memory geostreams API stand-in',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--port", type=int, default=9000, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=20, help="delay added to every request, in ms")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    server = start(args.port, args.latency, background=False)
+    print("geostreams stand-in on http://localhost:%s/" % server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+def start(port=0, latency=20, background=True):
+    """Create a stand-in server (port 0 picks a free port), serving on a daemon thread if background."""
+    server = StandinServer(('127.0.0.1', port), StandinHandler)
+    server.latency = latency/1000.0
+    if background:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return server
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.latency = 0.0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, keep_streams=False):
+        # Drop the stored datapoints and request counts, and the sensors/streams unless keep_streams
+        with self.lock:
+            if not keep_streams:
+                self.sensors = []
+                self.streams = []
+            self.datapoints = []
+            self.requests = {}
+
+    def count(self, method, path):
+        with self.lock:
+            key = "%s %s" % (method, path)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def add(self, collection, body):
+        with self.lock:
+            entry = dict(body, id=len(collection) + 1)
+            collection.append(entry)
+            return entry['id']
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so pooled sessions reuse their connections; without TCP_NODELAY
+    # the separate header and body writes stall on delayed ACKs
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, query = self.parse()
+        filters = {'/api/geostreams/sensors': (self.server.sensors, 'sensor_name'),
+                   '/api/geostreams/streams': (self.server.streams, 'stream_name')}
+        if path not in filters:
+            return self.reply(404, {"error": "not found"})
+        collection, name_arg = filters[path]
+        name = query.get(name_arg, [None])[0]
+        with self.server.lock:
+            self.reply(200, [entry for entry in collection if name is None or entry['name'] == name])
+
+    def do_POST(self):
+        path, query = self.parse()
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        server = self.server
+        if path == '/api/geostreams/sensors':
+            self.reply(200, {"id": server.add(server.sensors, body)})
+        elif path == '/api/geostreams/streams':
+            self.reply(200, {"id": server.add(server.streams, body)})
+        elif path == '/api/geostreams/datapoints':
+            self.reply(200, {"id": server.add(server.datapoints, body)})
+        elif path == '/api/geostreams/datapoints/bulk':
+            for datapoint in body['datapoints']:
+                server.add(server.datapoints, dict(datapoint, stream_id=body['stream_id']))
+            self.reply(200, {"status": "ok"})
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def parse(self):
+        url = urlparse(self.path)
+        self.server.count(self.command, url.path)
+        time.sleep(self.server.latency)
+        return url.path, parse_qs(url.query)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+'''
+Datapoint submission throughput against the local geostreams stand-in:
+per-plot terrautils.geostreams.create_datapoint_with_dependencies calls, as
+the extractors used to make, versus geostreams_batch.DatapointBatch.
+
+Plots are a synthetic grid of BETY-style sites. The BETY site lookup is
+answered locally with no added latency in every mode, so only the
+geostreams requests are compared. The batched run is repeated with warm
+sensor/stream caches, as for the second message an extractor handles.
+----------------------------------------------------------------------------------------
+Usage:
+python geostreams_throughput.py --plots 800 --latency 20 --workers 1,8,16 --json geostreams.json
+'''
+
+import os, sys, time, json, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'canopycover'))
+import geostreams_batch
+import geostreams_standin
+import terrautils.geostreams
+
+PLOT_SIZE = (0.00002, 0.00004)
+ORIGIN = (33.0745, -111.9750)
+TIMESTAMP = '2017-06-01'
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='Geostreams datapoint submission throughput',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--plots", type=int, default=800, help="plots (datapoints) per run")
+    parser.add_argument("--latency", type=float, default=20, help="stand-in delay per request, in ms")
+    parser.add_argument("--workers", default='1,8,16', help="comma-separated DatapointBatch worker counts")
+    parser.add_argument("--skip-sequential", action='store_true', help="do not time the per-plot terrautils path")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    server = geostreams_standin.start(latency=args.latency)
+    host = "http://127.0.0.1:%s/" % server.server_port
+    sites = plot_sites(args.plots)
+    lookup = lambda latlon, filter_date='', **kwargs: [sites[latlon]]
+
+    runs = []
+    if not args.skip_sequential:
+        terrautils.geostreams.get_sites_by_latlon = lookup
+        runs.append(("sequential", False, lambda: [terrautils.geostreams.create_datapoint_with_dependencies(
+            None, host, '', "Canopy Cover", latlon, TIMESTAMP, TIMESTAMP, {"canopy_cover": 0.5}, TIMESTAMP)
+            for latlon in sorted(sites)]))
+    for workers in [int(w) for w in args.workers.split(',')]:
+        submit = lambda workers=workers: submit_batch(host, sites, lookup, workers)
+        runs.append(("batched workers=%d" % workers, False, submit))
+        # same sensors and streams again, now cached
+        runs.append(("batched workers=%d warm" % workers, True, submit))
+
+    results = {"plots": args.plots, "latency_ms": args.latency, "runs": []}
+    for name, warm, run in runs:
+        server.reset(keep_streams=warm)
+        if not warm:
+            geostreams_batch._ids.clear()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if len(server.datapoints) != args.plots:
+            raise RuntimeError('%s created %s datapoints, expected %s' % (name, len(server.datapoints), args.plots))
+        requests = sum(server.requests.values())
+        results["runs"].append({"mode": name, "seconds": elapsed, "datapoints_per_s": args.plots/elapsed,
+                                "requests": requests, "requests_by_endpoint": dict(server.requests)})
+        print("%-26s %8.2fs  %8.1f datapoints/s  %6d requests" % (name, elapsed, args.plots/elapsed, requests))
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def submit_batch(host, sites, lookup, workers):
+    batch = geostreams_batch.DatapointBatch(None, host, '', "Canopy Cover", workers, site_lookup=lookup)
+    for latlon in sorted(sites):
+        batch.add(latlon, TIMESTAMP, TIMESTAMP, {"canopy_cover": 0.5}, TIMESTAMP)
+    return batch.flush()
+
+def plot_sites(count, columns=16):
+    # {(lat, lon) centroid: BETY site} for a grid of rectangular plots
+    sites = {}
+    for index in range(count):
+        row, col = divmod(index, columns)
+        lat, lon = ORIGIN[0] + row*PLOT_SIZE[1], ORIGIN[1] + col*PLOT_SIZE[0]
+        corners = [(lon, lat), (lon + PLOT_SIZE[0], lat), (lon + PLOT_SIZE[0], lat + PLOT_SIZE[1]),
+                   (lon, lat + PLOT_SIZE[1]), (lon, lat)]
+        centroid = (lat + PLOT_SIZE[1]/2, lon + PLOT_SIZE[0]/2)
+        sites[centroid] = {"sitename": "Synthetic Season Range %d Column %d" % (row + 1, col + 1),
+                           "geometry": "MULTIPOLYGON (((%s)))" % ", ".join("%r %r 0" % c for c in corners)}
+    return sites
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+'''
+Time the in-process gift feature table (gift_features.feature_table) and the
+persistent R worker (gift_worker.GiftWorker) against the per-plot PNG +
+Rscript gift.R path, and compare the tables of both with gift.R's column by
+column.
+
+Plot images are crops of synthetic scenes at several canopy fractions, or
+PNG/TIF files passed with --images. Without Rscript on the PATH only the
+numpy engine is timed.
+----------------------------------------------------------------------------------------
+Usage:
+python gift_texture.py --plots 20 --size 400x150 --json gift.json
+python gift_texture.py --images /data/plots/*.png --rtol 1e-6
+'''
+
+import os, sys, time, json, argparse, shutil, tempfile, subprocess
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+import numpy as np
+from PIL import Image
+
+GIFT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo-texture-analysis')
+sys.path.insert(0, GIFT_DIR)
+import gift_features
+import gift_worker
+import fixtures
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='numpy vs Rscript gift.R feature tables',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--images", nargs='*', default=[], help="RGB plot images to use instead of synthetic ones")
+    parser.add_argument("--plots", type=int, default=20, help="synthetic plot images")
+    parser.add_argument("--size", default='400x150', help="synthetic plot image size, WIDTHxHEIGHT")
+    parser.add_argument("--batch", type=int, default=32, help="plots per R worker batch")
+    parser.add_argument("--rtol", type=float, default=1e-6, help="relative tolerance for matching R values")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    workdir = tempfile.mkdtemp()
+    try:
+        images = args.images or synthetic_images(workdir, args.plots, [int(v) for v in args.size.split('x')])
+        rscript = which('Rscript')
+
+        results = {"images": len(images), "numpy_s": 0.0, "rscript_s": None, "r_worker_s": None, "mismatches": [],
+                   "r_worker_mismatches": []}
+        if rscript:
+            results["rscript_s"] = 0.0
+            results["r_worker_s"], worker_tables = r_worker_tables(images, args.batch)
+        for index, path in enumerate(images):
+            start = time.time()
+            # the numpy engine gets the decoded pixels; its time includes the same PNG read as R's
+            rgb = np.asarray(Image.open(path).convert('RGB'))
+            columns, rows = gift_features.feature_table(rgb)
+            results["numpy_s"] += time.time() - start
+
+            if rscript:
+                out_csv = os.path.join(workdir, 'table_%04d.csv' % index)
+                start = time.time()
+                subprocess.check_call([rscript, os.path.join(GIFT_DIR, 'gift.R'), '-f', path, '--table', '-o', out_csv],
+                                      stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+                results["rscript_s"] += time.time() - start
+                r_rows = read_table(out_csv)
+                results["mismatches"] += compare(path, columns, rows, r_rows, args.rtol)
+                if worker_tables[index] is None:
+                    results["r_worker_mismatches"].append([path, 'table', None, 'gift.R table'])
+                else:
+                    results["r_worker_mismatches"] += compare(path, worker_tables[index][0], worker_tables[index][1],
+                                                              r_rows, args.rtol)
+
+        print("numpy engine  %8.3fs  (%.1f ms/plot)" % (results["numpy_s"], 1000*results["numpy_s"]/len(images)))
+        if rscript:
+            print("Rscript gift.R %8.3fs  (%.1f ms/plot), %.0fx slower" % (
+                results["rscript_s"], 1000*results["rscript_s"]/len(images), results["rscript_s"]/results["numpy_s"]))
+            print("R worker       %8.3fs  (%.1f ms/plot, batches of %d, including start-up)" % (
+                results["r_worker_s"], 1000*results["r_worker_s"]/len(images), args.batch))
+            for mismatch in results["mismatches"]:
+                print("MISMATCH %s %s: numpy %s, R %s" % tuple(mismatch))
+            print("%d values outside rtol %g" % (len(results["mismatches"]), args.rtol))
+            for mismatch in results["r_worker_mismatches"]:
+                print("R WORKER MISMATCH %s %s: worker %s, gift.R %s" % tuple(mismatch))
+            print("%d R worker values outside rtol %g" % (len(results["r_worker_mismatches"]), args.rtol))
+        else:
+            print("Rscript not found; R tables not compared")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def r_worker_tables(images, batch):
+    # (seconds, [(columns, rows) or None per image]) of the persistent R worker
+    start = time.time()
+    worker = gift_worker.GiftWorker()
+    tables = []
+    try:
+        for first in range(0, len(images), batch):
+            tables += worker.tables([(np.asarray(Image.open(path).convert('RGB')), None)
+                                     for path in images[first:first+batch]])
+    finally:
+        worker.close()
+    return time.time() - start, tables
+
+def synthetic_images(workdir, count, size):
+    # Crops of synthetic field scenes at a range of canopy fractions, written as PNG like create_image does
+    paths = []
+    for index in range(count):
+        scene = fixtures.synthetic_scene(tuple(size), seed=index, canopy=0.05 + 0.9*index/max(count - 1, 1))
+        path = os.path.join(workdir, 'plot_%04d.png' % index)
+        Image.fromarray(scene).save(path)
+        paths.append(path)
+    return paths
+
+def read_table(path):
+    with open(path, 'r') as f:
+        lines = [line.rstrip('\n').split(';') for line in f if line.strip()]
+    return [dict(zip(lines[0], row)) for row in lines[1:]]
+
+def compare(image, columns, rows, r_rows, rtol):
+    # [image, column, numpy value, R value] for values that differ beyond rtol, and columns only one side has
+    mismatches = []
+    if len(rows) != len(r_rows):
+        return [[image, 'rows', len(rows), len(r_rows)]]
+    for row, r_row in zip(rows, r_rows):
+        values = dict(zip(columns, row))
+        for column in sorted(set(values) | set(r_row)):
+            if column not in values or column not in r_row:
+                mismatches.append([image, column, values.get(column), r_row.get(column)])
+            elif not np.isclose(float(values[column]), float(r_row[column]), rtol=rtol, atol=1e-12):
+                mismatches.append([image, column, values[column], r_row[column]])
+    return mismatches
+
+if __name__ == '__main__':
+
+    main()
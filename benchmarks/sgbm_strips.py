@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+'''
+Time disparity.compute_disparity over a synthetic rectified stereoTop pair
+at the quarter resolution the height recovery matches at, as one SGBM call
+and split into strips on threads, and report how far the stitched result is
+from the single call (disparity.strip_difference).
+
+The right image is the left one shifted by a disparity of soil plus raised
+canopy patches, within the 132-320 px window generate_height_hist keeps.
+----------------------------------------------------------------------------------------
+Usage:
+python sgbm_strips.py --strips 1,2,4,8 --repeat 3 --json sgbm.json
+'''
+
+import sys, os, time, json, argparse
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'height_recovery'))
+import disparity
+import fixtures
+
+# generate_height_hist's disparity search window
+MIN_DISP, NUM_DISP = 1, 320
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='single vs strip-parallel SGBM disparity',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--size", default='824x618', help="rectified pair size, WIDTHxHEIGHT")
+    parser.add_argument("--strips", default='1,2,4,8', help="comma-separated strip counts")
+    parser.add_argument("--overlap", type=int, default=disparity.OVERLAP, help="rows matched above and below each strip")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per setting; the best is reported")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    imgL, imgR, truth = synthetic_pair([int(v) for v in args.size.split('x')])
+
+    results = {"size": args.size, "overlap": args.overlap, "runs": []}
+    single_s = None
+    for strips in [int(v) for v in args.strips.split(',')]:
+        best = min(timed(disparity.compute_disparity, imgL, imgR, MIN_DISP, NUM_DISP, strips, args.overlap)
+                   for _ in range(args.repeat))
+        single_s = single_s or best
+        run = {"strips": strips, "seconds": best}
+        if strips > 1:
+            run.update(disparity.strip_difference(imgL, imgR, MIN_DISP, NUM_DISP, strips, args.overlap))
+        results["runs"].append(run)
+        print("%2d strips %7.3fs  %.1fx  %s" % (strips, best, single_s/best,
+                                              ', '.join('%s %.4f' % (k, run[k]) for k in sorted(run)
+                                                        if k not in ("strips", "seconds"))))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def synthetic_pair(size, seed=0, soil_disp=150.0, canopy_disp=90.0):
+    # Left image of soil and canopy, canopy patches (closer to the camera) at a
+    # larger disparity; returns the pair and the true disparity of each left pixel
+    width, height = size
+    left = cv2.cvtColor(fixtures.synthetic_scene((width, height), seed=seed, canopy=0.4), cv2.COLOR_RGB2BGR)
+    plant = (left[:, :, 1].astype(np.int16) - left[:, :, 2]) > 20
+    truth = (soil_disp + canopy_disp*cv2.GaussianBlur(plant.astype(np.float32), (0, 0), 4)).astype(np.float32)
+    # right pixel x shows left pixel x + d where d is that left pixel's disparity; solve by iteration
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    shift = truth
+    for _ in range(8):
+        shift = cv2.remap(truth, xx + shift, yy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    right = cv2.remap(left, xx + shift, yy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    return left, right, truth
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the full field thumbnail step of the fieldmosaic extractor with and
+without internal overviews in the per-capture GeoTIFFs.
+
+Synthetic captures are written on a grid with bin_to_geotiff.create_geotiff,
+once plain and once with OVERVIEW_LEVELS, then each set is mosaicked with
+gdalbuildvrt and reduced with gdal_translate -outsize, as in
+FullFieldMosaicStitcher.generateSingleMosaic.
+----------------------------------------------------------------------------------------
+Usage:
+python thumbnail_overviews.py -o /tmp/thumb_bench -n 64 --pct 2
+'''
+
+import os, sys, time, json, argparse, subprocess, shutil
+from math import ceil, sqrt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin2tif'))
+import bin_to_geotiff
+import bayer
+import fixtures
+
+
+def options():
+
+    parser = argparse.ArgumentParser(description='Thumbnail time with and without GeoTIFF overviews',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-o", "--out_dir", help="scratch directory for captures and mosaics")
+    parser.add_argument("-n", "--captures", type=int, default=64, help="number of synthetic captures")
+    parser.add_argument("--pct", default='2', help="gdal_translate -outsize percentage")
+    parser.add_argument("--repeat", type=int, default=3, help="thumbnail runs per variant; best is reported")
+    parser.add_argument("--json", help="optional file to write results to")
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = options()
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    frame = synthetic_capture()
+    results = {"captures": args.captures, "pct": args.pct, "frame_shape": list(frame.shape)}
+    for name, overviews in (("plain", None), ("overviews", bin_to_geotiff.OVERVIEW_LEVELS)):
+        case_dir = os.path.join(args.out_dir, name)
+        if os.path.exists(case_dir):
+            shutil.rmtree(case_dir)
+        os.makedirs(case_dir)
+
+        start = time.time()
+        tif_list = write_captures(case_dir, frame, args.captures, overviews)
+        write_s = time.time() - start
+
+        vrt = os.path.join(case_dir, 'fullfield.vrt')
+        subprocess.call('gdalbuildvrt -q -srcnodata "-99 -99 -99" -overwrite -input_file_list %s %s' % (tif_list, vrt),
+                        shell=True)
+        thumb_s = min(time_thumbnail(vrt, os.path.join(case_dir, 'fullfield_thumb.tif'), args.pct)
+                      for _ in range(args.repeat))
+
+        results[name] = {"write_s": write_s, "thumbnail_s": thumb_s, "bytes": dir_size(case_dir)}
+        print("%-10s write %8.2fs  thumbnail %8.2fs  %8.1f MB" % (name, write_s, thumb_s,
+                                                                   results[name]["bytes"]/1e6))
+
+    print("thumbnail speedup: %.1fx" % (results["plain"]["thumbnail_s"]/results["overviews"]["thumbnail_s"]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def synthetic_capture():
+    # Synthetic soil/canopy frame, demosaiced like a real one
+    return bayer.demosaic_rot90(fixtures.synthetic_bayer())
+
+def write_captures(out_dir, frame, count, overviews):
+    grid = int(ceil(sqrt(count)))
+    tif_list = os.path.join(out_dir, 'tif_list.txt')
+    with open(tif_list, 'w') as f:
+        for i in range(count):
+            bounds = fixtures.capture_bounds(i, grid)
+            tif_path = os.path.join(out_dir, 'capture_%04d.tif' % i)
+            bin_to_geotiff.create_geotiff('left', frame, bounds, tif_path, overviews=overviews)
+            f.write(tif_path + '\n')
+    return tif_list
+
+def time_thumbnail(vrt, out_tif, pct):
+    start = time.time()
+    subprocess.call("gdal_translate -q -outsize %s%% %s%% %s %s" % (pct, pct, vrt, out_tif), shell=True)
+    return time.time() - start
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+if __name__ == '__main__':
+
+    main()
@@ -14,11 +14,11 @@ input_folder        is the folder containing the metadata and binary stereo imag
 output_folder     is the folder where the output .jpg files and .tif files will be saved
 '''
 
-import sys, os.path, json
+import sys, os.path, json, multiprocessing
 from glob import glob
 from os.path import join
 import numpy as np
-from scipy.ndimage.filters import convolve
+from bayer import demosaic, demosaic_rot90, demosaic_rows, read_frame
 from PIL import Image
 from math import cos, pi
 from osgeo import gdal, osr
@@ -38,6 +38,12 @@ FOV_IN_2_METER_PARAM = 0.837 # since we don't have a true value of field of view
 # PARAMS FROM 5/25
 #HEIGHT_MAGIC_NUMBER = 1.3 # this is the value we have to add to our Z position to get the images in a column to line up.
 
+# Internal overview levels for per-capture GeoTIFFs; 32x covers the 2% full field thumbnail
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+OVERVIEW_RESAMPLING = 'AVERAGE'
+# Raw rows demosaiced per strip by create_geotiff_from_bin; a multiple of the tile size
+STRIP_ROWS = 256
+
 # Scanalyzer -> MAC formular @ https://terraref.gitbooks.io/terraref-documentation/content/user/geospatial-information.html
 # Mx = ax + bx * Gx + cx * Gy
 # My = ay + by * Gx + cy * Gy
@@ -48,7 +54,50 @@ lon_shift = 0.000020308287
 lat_shift = 0.000015258894
 SE_utm = utm.from_latlon(SE_latlon[0], SE_latlon[1])
 
-def main(in_dir, out_dir, tif_list_file, bounds):
+def main(in_dir, out_dir, tif_list_file, bounds, creation_options=None, cog=False, overviews=None):
+    tifs = convert_captures(in_dir, out_dir, bounds, creation_options, cog, overviews)
+    # once we've saved the images, make sure to append these paths to our list of TIFs
+    with open(tif_list_file,'a+') as f:
+        for tif in tifs:
+            f.write(tif + '\n')
+
+def process_day(in_dir, out_dir, tif_list_file, bounds, processes=None, chunksize=4, resume=False,
+                creation_options=None, cog=False, overviews=None):
+    """
+    Convert every capture subdirectory of in_dir on a pool of processes.
+
+    The TIFF list is collected in memory and written once, sorted, to
+    tif_list_file. With resume=True, captures whose TIFFs already exist in
+    out_dir are listed without being converted again.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    jobs = [(join(in_dir, d), join(out_dir, d), bounds, creation_options, cog, overviews, resume)
+            for d in sorted(os.listdir(in_dir)) if os.path.isdir(join(in_dir, d))]
+    pool = multiprocessing.Pool(processes)
+    try:
+        tifs = [tif for result in pool.imap_unordered(convert_captures_job, jobs, chunksize) for tif in result]
+    finally:
+        pool.close()
+        pool.join()
+
+    tifs.sort()
+    with open(tif_list_file, 'w') as f:
+        for tif in tifs:
+            f.write(tif + '\n')
+    return tifs
+
+def convert_captures_job(args):
+    # Pool entry point; a failed capture directory must not stop the rest of the day
+    try:
+        return convert_captures(*args)
+    except Exception as ex:
+        fail("\tFailed to process folder %s: %s" % (args[0], str(ex)))
+        return []
+
+def convert_captures(in_dir, out_dir, bounds, creation_options=None, cog=False, overviews=None, resume=False):
+    """Convert each stereo pair in in_dir and return the left GeoTIFF paths."""
     if not os.path.isdir(in_dir):
         fail('Could not find input directory: ' + in_dir)
     if not os.path.isdir(out_dir):
@@ -56,7 +105,16 @@ def main(in_dir, out_dir, tif_list_file, bounds):
 
     metas, ims_left, ims_right = find_input_files(in_dir)
 
+    tifs = []
     for meta, im_left, im_right in zip(metas, ims_left, ims_right):
+        left_baseName = os.path.basename(im_left)
+        right_baseName = os.path.basename(im_right)
+        left_tiff_out = join(out_dir,left_baseName[:-3]+'tif')
+        right_tiff_out = join(out_dir,right_baseName[:-3]+'tif')
+        if resume and os.path.isfile(left_tiff_out) and os.path.isfile(right_tiff_out):
+            tifs.append(left_tiff_out)
+            continue
+
         metadata = lower_keys(load_json(meta)) # make all our keys lowercase since keys appear to change case (???)
 
         left_shape = get_image_shape(metadata, 'left')
@@ -73,20 +131,32 @@ def main(in_dir, out_dir, tif_list_file, bounds):
 
         # check if this file is in the GPS bounds of interest
         #if left_gps_bounds[1] > bounds[0] and left_gps_bounds[0] < bounds[2] and left_gps_bounds[3] > bounds[1] and left_gps_bounds[2] < bounds[3]:
-        left_baseName = os.path.basename(im_left)
         left_out = join(out_dir, left_baseName[:-3]+'jpg')
         left_image = process_image(left_shape, im_left, left_out)
-        right_baseName = os.path.basename(im_right)
         right_out = join(out_dir, right_baseName[:-3]+'jpg')
         right_image = process_image(right_shape, im_right, right_out)
 
-        left_tiff_out = join(out_dir,left_baseName[:-3]+'tif')
-        create_geotiff('left', left_image, left_gps_bounds, left_tiff_out)
-        right_tiff_out = join(out_dir,right_baseName[:-3]+'tif')
-        create_geotiff('right', right_image, right_gps_bounds, right_tiff_out)
-        # once we've saved the image, make sure to append this path to our list of TIFs
-        with open(tif_list_file,'a+') as f:
-            f.write(left_tiff_out + '\n')
+        # write under a temporary name so an interrupted run never leaves a TIFF that resume would trust
+        left_ok = create_geotiff('left', left_image, left_gps_bounds, left_tiff_out+'.part', creation_options, cog,
+                                 overviews)
+        right_ok = create_geotiff('right', right_image, right_gps_bounds, right_tiff_out+'.part', creation_options,
+                                  cog, overviews)
+        left_ok = finish_tiff(left_tiff_out, left_ok)
+        right_ok = finish_tiff(right_tiff_out, right_ok)
+        if left_ok and right_ok:
+            tifs.append(left_tiff_out)
+
+    return tifs
+
+def finish_tiff(tiff_out, written):
+    # create_geotiff reports failures through fail(); drop what it left instead of renaming it
+    part = tiff_out+'.part'
+    if written and os.path.isfile(part):
+        os.rename(part, tiff_out)
+        return True
+    if os.path.exists(part):
+        os.remove(part)
+    return False
 
 def lower_keys(in_dict):
     if type(in_dict) is dict:
@@ -250,41 +320,51 @@ def get_bounding_box_with_formula(center_position, fov):
 
 def process_image(shape, in_file, out_file=None):
     try:
-        im = np.fromfile(in_file, dtype='uint8').reshape(shape[::-1])
-        im_color = demosaic(im)
-        im_color = (np.rot90(im_color))
+        # rotation is folded into the demosaic output indexing
+        im_color = demosaic_rot90(read_frame(in_file, shape))
         if out_file:
             Image.fromarray(im_color).save(out_file)
         return im_color
     except Exception as ex:
         fail('Error processing image "%s": %s' % (in_file, str(ex)))
 
-def demosaic(im):
-    # Assuming GBRG ordering.
-    B = np.zeros_like(im)
-    R = np.zeros_like(im)
-    G = np.zeros_like(im)
-    R[0::2, 1::2] = im[0::2, 1::2]
-    B[1::2, 0::2] = im[1::2, 0::2]
-    G[0::2, 0::2] = im[0::2, 0::2]
-    G[1::2, 1::2] = im[1::2, 1::2]
-
-    fG = np.asarray(
-            [[0, 1, 0],
-             [1, 4, 1],
-             [0, 1, 0]]) / 4.0
-    fRB = np.asarray(
-            [[1, 2, 1],
-             [2, 4, 2],
-             [1, 2, 1]]) / 4.0
-
-    im_color = np.zeros(im.shape+(3,), dtype='uint8') #RGB
-    im_color[:, :, 0] = convolve(R, fRB)
-    im_color[:, :, 1] = convolve(G, fG)
-    im_color[:, :, 2] = convolve(B, fRB)
-    return im_color
-
-def create_geotiff(which_im, np_arr, gps_bounds, out_file_path):
+def geotiff_options(tiled=True, blocksize=256, compress=None, predictor=None,
+                    jpeg_quality=None, bigtiff=None):
+    """
+    Build a GTiff creation option list for create_geotiff.
+
+    compress is None, 'DEFLATE', 'LZW' or 'JPEG'. predictor (2 = horizontal
+    differencing) applies to DEFLATE/LZW, jpeg_quality to JPEG. bigtiff is
+    passed through as BIGTIFF=<YES|NO|IF_NEEDED|IF_SAFER>.
+    """
+    options = ['INTERLEAVE=PIXEL']
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE=%d' % blocksize, 'BLOCKYSIZE=%d' % blocksize]
+    if compress:
+        compress = compress.upper()
+        options.append('COMPRESS=%s' % compress)
+        if compress == 'JPEG':
+            options.append('PHOTOMETRIC=YCBCR')
+            if jpeg_quality:
+                options.append('JPEG_QUALITY=%d' % jpeg_quality)
+        elif predictor:
+            options.append('PREDICTOR=%d' % predictor)
+    if bigtiff:
+        options.append('BIGTIFF=%s' % bigtiff)
+    return options
+
+def create_geotiff(which_im, np_arr, gps_bounds, out_file_path, creation_options=None, cog=False,
+                   overviews=None):
+    """
+    Write an (rows, cols, 3) uint8 image to a pixel-interleaved GeoTIFF.
+
+    creation_options is a GTiff option list (see geotiff_options); by default
+    the file is untiled and uncompressed. cog=True gives the Cloud Optimized
+    GeoTIFF layout: tiled, with the IFDs ahead of the data. It builds no
+    overviews by itself; overviews is a list of decimation levels (e.g.
+    OVERVIEW_LEVELS) to build as internal overviews, which cog=True then
+    places ahead of the data too.
+    """
     try:
         nrows,ncols,nz = np.shape(np_arr)
         # gps_bounds: (lat_min, lat_max, lng_min, lng_max)
@@ -292,30 +372,107 @@ def create_geotiff(which_im, np_arr, gps_bounds, out_file_path):
         yres = (gps_bounds[1] - gps_bounds[0])/float(nrows)
         geotransform = (gps_bounds[2],xres,0,gps_bounds[1],0,-yres) #(top left x, w-e pixel resolution, rotation (0 if North is up), top left y, rotation (0 if North is up), n-s pixel resolution)
 
-        output_raster = gdal.GetDriverByName('GTiff').Create(out_file_path, ncols, nrows, nz, gdal.GDT_Byte)
+        options = list(creation_options or [])
+        if cog:
+            # COG layout can only be produced by copying a finished dataset
+            output_raster = gdal.GetDriverByName('MEM').Create('', ncols, nrows, nz, gdal.GDT_Byte)
+        else:
+            output_raster = gdal.GetDriverByName('GTiff').Create(out_file_path, ncols, nrows, nz, gdal.GDT_Byte, options)
 
         output_raster.SetGeoTransform(geotransform) # specify coordinates
         srs = osr.SpatialReference() # establish coordinate encoding
         srs.ImportFromEPSG(4326) # specifically, google mercator
         output_raster.SetProjection( srs.ExportToWkt() ) # export coordinate system to file
 
-        # TODO: Something wonky w/ uint8s --> ending up w/ lots of gaps in data (white pixels)
-        output_raster.GetRasterBand(1).WriteArray(np_arr[:,:,0].astype('uint8')) # write red channel to raster file
-        output_raster.GetRasterBand(1).FlushCache()
-        output_raster.GetRasterBand(1).SetNoDataValue(-99)
+        write_interleaved(output_raster, np_arr)
+        for band in range(1, nz+1):
+            output_raster.GetRasterBand(band).SetNoDataValue(-99)
+        if overviews:
+            output_raster.BuildOverviews(OVERVIEW_RESAMPLING, list(overviews))
 
-        output_raster.GetRasterBand(2).WriteArray(np_arr[:,:,1].astype('uint8')) # write green channel to raster file
-        output_raster.GetRasterBand(2).FlushCache()
-        output_raster.GetRasterBand(2).SetNoDataValue(-99)
-
-        output_raster.GetRasterBand(3).WriteArray(np_arr[:,:,2].astype('uint8')) # write blue channel to raster file
-        output_raster.GetRasterBand(3).FlushCache()
-        output_raster.GetRasterBand(3).SetNoDataValue(-99)
+        if cog:
+            if 'TILED=YES' not in options:
+                options.append('TILED=YES')
+            cog_raster = gdal.GetDriverByName('GTiff').CreateCopy(out_file_path, output_raster,
+                                                                  options=options+['COPY_SRC_OVERVIEWS=YES'])
+            cog_raster = None
 
         output_raster = None
+        return True
     except Exception as ex:
         fail('Error creating GeoTIFF: ' + str(ex))
 
+def create_geotiff_from_bin(which_im, in_file, shape, gps_bounds, out_file_path, creation_options=None,
+                            overviews=None, strip_rows=STRIP_ROWS, nodata=-99, tags=None):
+    """
+    Demosaic a raw .bin frame straight into a GeoTIFF, strip_rows raw rows at
+    a time, in the same rotated orientation as process_image.
+
+    The raw frame is memory-mapped and each strip is written and flushed
+    before the next one is read, so peak memory is a few strips rather than
+    several full frames. A strip of raw rows is a column strip of the rotated
+    output, so the file should be tiled (the default here) with strip_rows a
+    multiple of the tile size. COG output needs the whole image and is not
+    supported; use create_geotiff for that. tags is an optional dict of
+    dataset metadata items.
+    """
+    try:
+        frame = read_frame(in_file, shape)
+        height, width = frame.shape
+        # rotated output: raw columns become rows and raw rows become columns
+        nrows, ncols, nz = width, height, 3
+        xres = (gps_bounds[3] - gps_bounds[2])/float(ncols)
+        yres = (gps_bounds[1] - gps_bounds[0])/float(nrows)
+        geotransform = (gps_bounds[2],xres,0,gps_bounds[1],0,-yres)
+
+        options = list(creation_options or geotiff_options())
+        output_raster = gdal.GetDriverByName('GTiff').Create(out_file_path, ncols, nrows, nz, gdal.GDT_Byte, options)
+        output_raster.SetGeoTransform(geotransform)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        output_raster.SetProjection( srs.ExportToWkt() )
+        if tags:
+            output_raster.SetMetadata(tags)
+
+        strip_rows += strip_rows % 2 # strips must start on an even row
+        for start in range(0, height, strip_rows):
+            strip = demosaic_rows(frame, start, start+strip_rows)
+            write_interleaved(output_raster, np.rot90(strip), xoff=start)
+            # push the finished tiles out of the block cache
+            output_raster.FlushCache()
+            del strip
+
+        if nodata is not None:
+            for band in range(1, nz+1):
+                output_raster.GetRasterBand(band).SetNoDataValue(nodata)
+        if overviews:
+            output_raster.BuildOverviews(OVERVIEW_RESAMPLING, list(overviews))
+        output_raster = None
+    except Exception as ex:
+        fail('Error creating GeoTIFF from "%s": %s' % (in_file, str(ex)))
+
+def build_overviews(tif_path, overviews=None):
+    # Add internal overviews to a GeoTIFF written elsewhere (e.g. by terrautils)
+    try:
+        raster = gdal.Open(tif_path, gdal.GA_Update)
+        raster.BuildOverviews(OVERVIEW_RESAMPLING, list(overviews or OVERVIEW_LEVELS))
+        raster = None
+    except Exception as ex:
+        fail('Error building overviews for %s: %s' % (tif_path, str(ex)))
+
+def write_interleaved(output_raster, np_arr, xoff=0, yoff=0):
+    # One RasterIO call for all bands straight from the (rows, cols, bands) buffer,
+    # placed at (xoff, yoff) in the raster
+    nrows,ncols,nz = np.shape(np_arr)
+    buf = np.ascontiguousarray(np_arr, dtype=np.uint8)
+    layout = dict(buf_type=gdal.GDT_Byte, band_list=list(range(1, nz+1)),
+                  buf_pixel_space=nz, buf_line_space=nz*ncols, buf_band_space=1)
+    try:
+        output_raster.WriteRaster(xoff, yoff, ncols, nrows, buf.data, **layout)
+    except TypeError:
+        # older bindings only accept a byte string
+        output_raster.WriteRaster(xoff, yoff, ncols, nrows, buf.tostring(), **layout)
+
 def fail(reason):
     print >> sys.stderr, reason
 
@@ -11,6 +11,7 @@ import os
 import logging
 import shutil
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from pyclowder.utils import CheckMessage
 from pyclowder.datasets import download_metadata, upload_metadata, remove_metadata
@@ -21,15 +22,48 @@ from terrautils.formats import create_geotiff, create_image
 from terrautils.spatial import geojson_to_tuples
 
 import bin_to_geotiff as bin2tiff
-
+import stage_timer
+
+
+def add_local_arguments(parser):
+    # add any additional arguments to parser
+    stage_timer.add_arguments(parser)
+    parser.add_argument('--overviews', default=os.getenv('BIN2TIF_OVERVIEWS', ''),
+                        help="comma-separated internal overview levels to build in each GeoTIFF, e.g. 2,4,8,16,32")
+    parser.add_argument('--workers', type=int, default=os.getenv('BIN2TIF_WORKERS', 1),
+                        help="threads used to process the left and right images of a capture concurrently")
+    parser.add_argument('--strip-rows', type=int, default=os.getenv('BIN2TIF_STRIP_ROWS', 0),
+                        help="demosaic and write each GeoTIFF this many raw rows at a time (tiled output) to cap memory; 0 converts whole frames")
+
+def geotiff_tags(extractor_info, system_md):
+    # Same dataset metadata items terrautils.formats.create_geotiff writes
+    tags = {
+        "datetime": str(system_md["gantry_variable_metadata"]["datetime"]),
+        "sensor_id": str(system_md["sensor_fixed_metadata"]["sensor_id"]),
+        "sensor_url": str(system_md["sensor_fixed_metadata"]["url"]),
+        "experiment_name": ", ".join(e["name"] for e in system_md["experiment_metadata"]),
+        "extractor_name": str(extractor_info.get("name", "")),
+        "extractor_version": str(extractor_info.get("version", "")),
+        "extractor_author": str(extractor_info.get("author", "")),
+        "extractor_description": str(extractor_info.get("description", "")),
+        "extractor_repo": str(extractor_info["repository"]["repUrl"])
+    }
+    return tags
 
 class StereoBin2JpgTiff(TerrarefExtractor):
     def __init__(self):
         super(StereoBin2JpgTiff, self).__init__()
 
+        add_local_arguments(self.parser)
+
         # parse command line and load default logging configuration
         self.setup(sensor='rgb_geotiff')
 
+        # assign local arguments
+        self.overviews = [int(level) for level in self.args.overviews.split(',') if level.strip()]
+        self.workers = int(self.args.workers)
+        self.strip_rows = int(self.args.strip_rows)
+
     def check_message(self, connector, host, secret_key, resource, parameters):
         if "rulechecked" in parameters and parameters["rulechecked"]:
             return CheckMessage.download
@@ -75,17 +109,19 @@ class StereoBin2JpgTiff(TerrarefExtractor):
 
     def process_message(self, connector, host, secret_key, resource, parameters):
         self.start_message(resource)
+        timer = stage_timer.StageTimer(self.extractor_info['name'], resource['id'])
 
         # Get left/right files and metadata
         img_left, img_right, metadata = None, None, None
-        for fname in resource['local_paths']:
-            if fname.endswith('_dataset_metadata.json'):
-                all_dsmd = load_json_file(fname)
-                metadata = get_terraref_metadata(all_dsmd, 'stereoTop')
-            elif fname.endswith('_left.bin'):
-                img_left = fname
-            elif fname.endswith('_right.bin'):
-                img_right = fname
+        with timer.stage('load_metadata'):
+            for fname in resource['local_paths']:
+                if fname.endswith('_dataset_metadata.json'):
+                    all_dsmd = load_json_file(fname)
+                    metadata = get_terraref_metadata(all_dsmd, 'stereoTop')
+                elif fname.endswith('_left.bin'):
+                    img_left = fname
+                elif fname.endswith('_right.bin'):
+                    img_right = fname
         if None in [img_left, img_right, metadata]:
             self.log_error("could not locate each of left+right+metadata in processing")
             raise ValueError("could not locate each of left+right+metadata in processing")
@@ -103,55 +139,90 @@ class StereoBin2JpgTiff(TerrarefExtractor):
         right_gps_bounds = geojson_to_tuples(metadata['spatial_metadata']['right']['bounding_box'])
         out_tmp_tiff = os.path.join(tempfile.gettempdir(), resource['id'].encode('utf8'))
 
-        target_dsid = build_dataset_hierarchy(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
-                                              self.sensors.get_display_name(),
-                                              timestamp[:4], timestamp[5:7], timestamp[8:10],
-                                              leaf_ds_name=self.sensors.get_display_name()+' - '+timestamp)
-
-        if (not os.path.isfile(left_tiff)) or self.overwrite:
-            self.log_info(resource, "creating & uploading %s" % left_tiff)
-            left_image = bin2tiff.process_image(left_shape, img_left, None)
-            # Rename output.tif after creation to avoid long path errors
-            create_geotiff(left_image, left_gps_bounds, out_tmp_tiff, None, False, self.extractor_info, metadata)
-            # TODO: we're moving zero byte files
-            shutil.move(out_tmp_tiff, left_tiff)
-            if left_tiff not in resource['local_paths']:
-                fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid, left_tiff)
-                uploaded_file_ids.append(host + ("" if host.endswith("/") else "/") + "files/" + fileid)
-            else:
-                self.log_info(resource, "file found in dataset already; not re-uploading")
-            self.created += 1
-            self.bytes += os.path.getsize(left_tiff)
-
-        if (not os.path.isfile(right_tiff)) or self.overwrite:
-            self.log_info(resource, "creating & uploading %s" % right_tiff)
-            right_image = bin2tiff.process_image(right_shape, img_right, None)
-            create_geotiff(right_image, right_gps_bounds, out_tmp_tiff, None, False, self.extractor_info, metadata)
-            shutil.move(out_tmp_tiff, right_tiff)
-            if right_tiff not in resource['local_paths']:
-                fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid,right_tiff)
+        with timer.stage('dataset_hierarchy'):
+            target_dsid = build_dataset_hierarchy(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                                  self.sensors.get_display_name(),
+                                                  timestamp[:4], timestamp[5:7], timestamp[8:10],
+                                                  leaf_ds_name=self.sensors.get_display_name()+' - '+timestamp)
+
+        # Each side is independent; with --workers 2 they are converted and uploaded concurrently.
+        # Peak memory is one RGB frame per worker.
+        sides = []
+        for side, shape, img, gps_bounds, tiff in [('left', left_shape, img_left, left_gps_bounds, left_tiff),
+                                                   ('right', right_shape, img_right, right_gps_bounds, right_tiff)]:
+            if (not os.path.isfile(tiff)) or self.overwrite:
+                sides.append((side, shape, img, gps_bounds, tiff))
+
+        def convert(args):
+            return self.process_side(connector, host, resource, target_dsid, metadata, out_tmp_tiff, timer, *args)
+
+        if self.workers > 1 and len(sides) > 1:
+            pool = ThreadPool(min(self.workers, len(sides)))
+            try:
+                results = pool.map(convert, sides)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [convert(args) for args in sides]
+
+        # Merge in left, right order
+        for tiff, fileid in results:
+            if fileid:
                 uploaded_file_ids.append(host + ("" if host.endswith("/") else "/") + "files/" + fileid)
-            else:
-                self.log_info(resource, "file found in dataset already; not re-uploading")
             self.created += 1
-            self.bytes += os.path.getsize(right_tiff)
+            self.bytes += os.path.getsize(tiff)
 
         # Tell Clowder this is completed so subsequent file updates don't daisy-chain
         ext_meta = build_metadata(host, self.extractor_info, resource['id'], {
-                "files_created": uploaded_file_ids
+                "files_created": uploaded_file_ids,
+                "stage_timings": timer.summary(pending=['metadata_post'])
             }, 'dataset')
         self.log_info(resource, "uploading extractor metadata")
-        upload_metadata(connector, host, secret_key, resource['id'], ext_meta)
+        with timer.stage('metadata_post'):
+            upload_metadata(connector, host, secret_key, resource['id'], ext_meta)
 
-        # Upload original Lemnatec metadata to new Level_1 dataset
-        md = get_terraref_metadata(all_dsmd)
-        md['raw_data_source'] = host + ("" if host.endswith("/") else "/") + "datasets/" + resource['id']
-        lemna_md = build_metadata(host, self.extractor_info, target_dsid, md, 'dataset')
-        self.log_info(resource, "uploading LemnaTec metadata")
-        upload_metadata(connector, host, secret_key, target_dsid, lemna_md)
+            # Upload original Lemnatec metadata to new Level_1 dataset
+            md = get_terraref_metadata(all_dsmd)
+            md['raw_data_source'] = host + ("" if host.endswith("/") else "/") + "datasets/" + resource['id']
+            lemna_md = build_metadata(host, self.extractor_info, target_dsid, md, 'dataset')
+            self.log_info(resource, "uploading LemnaTec metadata")
+            upload_metadata(connector, host, secret_key, target_dsid, lemna_md)
 
+        timer.write(self.args.timing_log)
         self.end_message(resource)
 
+    def process_side(self, connector, host, resource, target_dsid, metadata, out_tmp_tiff, timer,
+                     side, shape, img, gps_bounds, tiff):
+        """Create and upload the GeoTIFF for one side; returns (tiff path, uploaded file id or None)."""
+        self.log_info(resource, "creating & uploading %s" % tiff)
+        # Rename output.tif after creation to avoid long path errors
+        tmp_tiff = "%s_%s" % (out_tmp_tiff, side)
+        if self.strip_rows:
+            # demosaic and write are interleaved per strip, so they are timed together
+            with timer.stage('geotiff_write', os.path.getsize(img)):
+                bin2tiff.create_geotiff_from_bin(side, img, shape, gps_bounds, tmp_tiff, overviews=self.overviews,
+                                                 strip_rows=self.strip_rows, nodata=None,
+                                                 tags=geotiff_tags(self.extractor_info, metadata))
+        else:
+            with timer.stage('demosaic', os.path.getsize(img)):
+                image = bin2tiff.process_image(shape, img, None)
+            with timer.stage('geotiff_write', image.nbytes):
+                create_geotiff(image, gps_bounds, tmp_tiff, None, False, self.extractor_info, metadata)
+            del image
+            if self.overviews:
+                with timer.stage('overviews'):
+                    bin2tiff.build_overviews(tmp_tiff, self.overviews)
+        # TODO: we're moving zero byte files
+        shutil.move(tmp_tiff, tiff)
+        fileid = None
+        if tiff not in resource['local_paths']:
+            with timer.stage('upload', os.path.getsize(tiff)):
+                fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid, tiff)
+        else:
+            self.log_info(resource, "file found in dataset already; not re-uploading")
+        return (tiff, fileid)
+
 if __name__ == "__main__":
     extractor = StereoBin2JpgTiff()
     extractor.start()
@@ -0,0 +1,72 @@
+'''
+Box filtering of binary masks in numpy, replacing the PIL ImageFilter round
+trip of the green masks in canopyCover and stereo_match.
+
+The filter is separable: small windows add shifted slices in uint8, larger
+ones take differences of running sums (an integral image along each axis),
+so the cost stops growing with the kernel size. Rows are processed
+in chunks with a halo, so arbitrarily large mosaics need only a few chunks
+of working memory. Borders repeat the edge pixels, as PIL's filters do.
+
+The module is copied into each extractor directory that uses it; keep the
+copies identical.
+'''
+
+import numpy as np
+
+# Output rows per chunk
+CHUNK_ROWS = 1024
+
+
+def box_count(mask, size, chunk_rows=CHUNK_ROWS):
+    """
+    Number of set pixels in the size x size window around each pixel of a 2D
+    boolean mask. Even sizes put the extra row/column before the pixel, like
+    OpenCV's default anchor.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    rows, cols = mask.shape
+    before = size // 2
+    after = size - 1 - before
+    if size*size < 2**8:
+        dtype, window_sum = np.uint8, _shifted_sum
+    else:
+        dtype, window_sum = (np.uint16 if size*size < 2**16 else np.uint32), _running_sum
+
+    counts = np.empty((rows, cols), dtype=dtype)
+    for top in range(0, rows, chunk_rows):
+        bottom = min(top + chunk_rows, rows)
+        # halo rows, repeating the first/last row at the image border
+        index = np.clip(np.arange(top - before, bottom + after), 0, rows - 1)
+        block = np.pad(mask[index].view(np.uint8), ((0, 0), (before, after)), mode='edge')
+        counts[top:bottom] = window_sum(window_sum(block.astype(dtype), size, 1), size, 0)
+    return counts
+
+
+def majority(mask, size, threshold=128, chunk_rows=CHUNK_ROWS):
+    """
+    Blur a 0/255 mask with a size x size mean filter and keep the pixels
+    whose blurred value is above threshold. The comparison is done on the
+    integer counts, so no blurred image is materialised.
+    """
+    # 255 * count / size**2 > threshold  <=>  count > threshold * size**2 // 255
+    return box_count(mask, size, chunk_rows) > (threshold * size * size) // 255
+
+
+def _shifted_sum(a, size, axis):
+    # Sums of size consecutive elements along axis, adding shifted views
+    a = np.swapaxes(a, 0, axis)
+    n = a.shape[0] - size + 1
+    out = a[0:n].copy(order='K')
+    for i in range(1, size):
+        out += a[i:i+n]
+    return np.swapaxes(out, 0, axis)
+
+
+def _running_sum(a, size, axis):
+    # Sums of size consecutive elements along axis, from a running sum; the
+    # differences are exact modulo 2**bits, so the running sum may wrap
+    c = np.swapaxes(np.cumsum(a, axis=axis, dtype=a.dtype), 0, axis)
+    out = c[size-1:].copy(order='K')
+    out[1:] -= c[:-size]
+    return np.swapaxes(out, 0, axis)
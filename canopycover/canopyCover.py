@@ -5,8 +5,9 @@ Created on Oct 31, 2016
 '''
 import os, sys, json
 from glob import glob
-from PIL import Image, ImageFilter
-from scipy.ndimage.filters import convolve
+from PIL import Image
+from bayer import demosaic, demosaic_rot90, read_frame
+import box_filter
 import numpy as np
 import terra_common
 import matplotlib.pyplot as plt
@@ -125,7 +126,10 @@ def get_localdatetime(metadata):
     return localTime
 
 
-def get_CC_from_bin(file_path):
+def get_CC_from_bin(file_path, bayer_domain=False):
+    
+    if bayer_domain:
+        return gen_cc_for_bayer(read_frame(file_path, [3296, 2472]), 5)
     
     image = process_image(file_path, [3296, 2472])
     
@@ -135,64 +139,62 @@ def get_CC_from_bin(file_path):
 
 def gen_cc_for_img(img, kernelSize):
     
-    #im = Image.fromarray(img)
+    sub_mask = gen_cc_mask(img, kernelSize)
     
-    #r, g, b = im.split()
+    c = np.count_nonzero(sub_mask)
+    ratio = c/float(sub_mask.size)
+    
+    return ratio
+
+def gen_cc_mask(img, kernelSize):
+    """
+    Boolean plant mask of an (rows, cols, 3) RGB image: pixels with
+    g - r - 2 > 0, blurred with a kernelSize x kernelSize mean filter and
+    thresholded at 128.
+    """
     
     r = img[:,:,0]
     g = img[:,:,1]
-    b = img[:,:,2]
-    
-    sub_img = (g.astype('int') - r.astype('int') - 2) > 0
-    
-    mask = np.zeros_like(b)
     
-    mask[sub_img] = 255
+    sub_img = np.subtract(g, r, dtype=np.int16) > 2
     
-    im = Image.fromarray(mask)
-    blur = im.filter(ImageFilter.BLUR)
-    pix = np.array(blur)
-    #blur = cv2.blur(mask,(kernelSize,kernelSize))
-    sub_mask = pix > 128
+    sub_mask = box_filter.majority(sub_img, kernelSize)
     
+    return sub_mask
+
+def gen_cc_for_bayer(raw, kernelSize):
+    """
+    Canopy cover straight from a raw BayerGR8 frame, without demosaicing.
+
+    Each G R / B G cell is one superpixel with g the mean of its two greens,
+    so the g - r - 2 > 0 test of gen_cc_for_img becomes G1 + G2 - 2R > 4 on a
+    quarter resolution mask. The blur window is halved to match, rounding up
+    to an odd size (5 -> 3).
+    """
+    raw = np.asarray(raw)
+    h, w = raw.shape
+    h -= h % 2
+    w -= w % 2
+    red = raw[0:h:2, 1:w:2]
+    index = raw[0:h:2, 0:w:2].astype(np.int16)
+    index += raw[1:h:2, 1:w:2]
+    index -= red
+    index -= red
+    plant = index > 4
+
+    sub_mask = box_filter.majority(plant, (kernelSize // 2) | 1)
+
     c = np.count_nonzero(sub_mask)
-    ratio = c/float(b.size)
+    ratio = c/float(sub_mask.size)
     
     return ratio
 
 def process_image(im_path, shape):
-    im = np.fromfile(im_path, dtype='uint8').reshape(shape[::-1])
-    im_color = demosaic(im)
-    im_color = np.rot90(im_color)
+    im_color = demosaic_rot90(read_frame(im_path, shape))
     #out_path = im_path[:-4] + '.jpg'
     #Image.fromarray(im_color).save(out_path)
     return im_color
 
-def demosaic(im):
-    # Assuming GBRG ordering.
-    B = np.zeros_like(im)
-    R = np.zeros_like(im)
-    G = np.zeros_like(im)
-    R[0::2, 1::2] = im[0::2, 1::2]
-    B[1::2, 0::2] = im[1::2, 0::2]
-    G[0::2, 0::2] = im[0::2, 0::2]
-    G[1::2, 1::2] = im[1::2, 1::2]
-
-    fG = np.asarray(
-            [[0, 1, 0],
-             [1, 4, 1],
-             [0, 1, 0]]) / 4.0
-    fRB = np.asarray(
-            [[1, 2, 1],
-             [2, 4, 2],
-             [1, 2, 1]]) / 4.0
-
-    im_color = np.zeros(im.shape+(3,), dtype='uint8') #RGB
-    im_color[:, :, 0] = convolve(R, fRB)
-    im_color[:, :, 1] = convolve(G, fG)
-    im_color[:, :, 2] = convolve(B, fRB)
-    return im_color
-
 def load_json(meta_path):
     try:
         with open(meta_path, 'r') as fin:
@@ -0,0 +1,97 @@
+'''
+Per-stage wall time, CPU time and byte counts for one extractor message.
+
+    timer = StageTimer(self.extractor_info['name'], resource['id'])
+    with timer.stage('geotiff_write') as st:
+        create_geotiff(...)
+        st.bytes += os.path.getsize(tif)
+    ...
+    timer.write(self.args.timing_log)
+
+The summary goes into the extractor metadata and, if --timing-log /
+STAGE_TIMING_LOG is set, is appended to that file as one JSON line per
+message. The metadata copy is taken before it is posted, so it lists the
+stages still to come as pending; the JSON-lines log is the complete record.
+
+The module is copied into each extractor directory; keep the copies identical.
+'''
+
+import os, json, time, threading
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def add_arguments(parser):
+    parser.add_argument('--timing-log', default=os.getenv('STAGE_TIMING_LOG', ''),
+                        help="append per-message stage timings to this JSON-lines file")
+
+
+class StageRun(object):
+    # Handle yielded by StageTimer.stage so the body can report bytes
+    def __init__(self, nbytes=0):
+        self.bytes = nbytes
+
+
+class StageTimer(object):
+    """
+    Accumulates timings per named stage, in the order stages are first seen.
+
+    A stage may be entered many times (e.g. once per plot); its times, bytes
+    and count add up. CPU time is process time, so stages that overlap in
+    threads each include the other's CPU use.
+    """
+
+    def __init__(self, extractor=None, resource_id=None):
+        self.extractor = extractor
+        self.resource_id = resource_id
+        self.started = datetime.utcnow().isoformat() + 'Z'
+        self._start = time.time()
+        self._stages = []
+        self._index = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        run = StageRun(nbytes)
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield run
+        finally:
+            self.add(name, time.time() - wall, _cpu_time() - cpu, run.bytes)
+
+    def add(self, name, wall_s=0.0, cpu_s=0.0, nbytes=0):
+        with self._lock:
+            if name not in self._index:
+                self._index[name] = len(self._stages)
+                self._stages.append({"stage": name, "wall_s": 0.0, "cpu_s": 0.0, "bytes": 0, "count": 0})
+            entry = self._stages[self._index[name]]
+            entry["wall_s"] += wall_s
+            entry["cpu_s"] += cpu_s
+            entry["bytes"] += nbytes
+            entry["count"] += 1
+
+    def summary(self, pending=None):
+        """Timings so far; pending names stages not run yet, which the summary does not include."""
+        with self._lock:
+            stages = [dict(s, wall_s=round(s["wall_s"], 4), cpu_s=round(s["cpu_s"], 4)) for s in self._stages]
+        summary = {"total_s": round(time.time() - self._start, 4), "stages": stages}
+        if pending:
+            summary["pending"] = list(pending)
+            summary["complete_record"] = "timing log"
+        return summary
+
+    def write(self, path):
+        """Append the summary to a JSON-lines file; no-op if path is empty."""
+        if not path:
+            return
+        record = {"extractor": self.extractor, "resource": self.resource_id, "started": self.started}
+        record.update(self.summary())
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    # Python 2: process CPU time on Unix
+    _cpu_time = time.clock
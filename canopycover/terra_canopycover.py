@@ -1,21 +1,23 @@
 #!/usr/bin/env python
 
+import os
 import json
 import logging
 import re
-from numpy import asarray, rollaxis
 
 from pyclowder.utils import CheckMessage
 from pyclowder.datasets import download_metadata, get_info, upload_metadata
 from terrautils.extractors import TerrarefExtractor, is_latest_file, load_json_file, \
     build_metadata, build_dataset_hierarchy
-from terrautils.betydb import add_arguments, get_sites, get_sites_by_latlon, submit_traits, \
-    get_site_boundaries
-from terrautils.geostreams import create_datapoint_with_dependencies
-from terrautils.gdal import clip_raster, centroid_from_geojson
+from terrautils.betydb import add_arguments, get_sites, get_sites_by_latlon, submit_traits
+from terrautils.gdal import centroid_from_geojson
 from terrautils.metadata import get_extractor_metadata, get_terraref_metadata
 
 import canopyCover as ccCore
+import zonal_stats
+import stage_timer
+import geostreams_batch
+import plot_cache
 
 
 logging.basicConfig(format='%(asctime)s %(message)s')
@@ -23,6 +25,11 @@ logging.basicConfig(format='%(asctime)s %(message)s')
 def add_local_arguments(parser):
     # add any additional arguments to parser
     add_arguments(parser)
+    stage_timer.add_arguments(parser)
+    geostreams_batch.add_arguments(parser)
+    plot_cache.add_arguments(parser)
+    parser.add_argument('--plot-workers', type=int, default=os.getenv('PLOT_WORKERS', 1),
+                        help="processes computing plot canopy cover over blocks of the field mosaic")
 
 class CanopyCoverHeight(TerrarefExtractor):
     def __init__(self):
@@ -36,6 +43,9 @@ class CanopyCoverHeight(TerrarefExtractor):
         # assign other argumentse
         self.bety_url = self.args.bety_url
         self.bety_key = self.args.bety_key
+        self.plot_workers = int(self.args.plot_workers)
+        self.plot_cache = plot_cache.PlotCache(self.args.plot_cache, self.args.plot_cache_ttl,
+                                               self.args.plot_cache_arrays)
 
     def check_message(self, connector, host, secret_key, resource, parameters):
         if resource['name'].find('fullfield') > -1 and re.match("^.*\d+_rgb_.*thumb.tif", resource['name']):
@@ -50,6 +60,7 @@ class CanopyCoverHeight(TerrarefExtractor):
 
     def process_message(self, connector, host, secret_key, resource, parameters):
         self.start_message()
+        timer = stage_timer.StageTimer(self.extractor_info['name'], resource['id'])
 
         tmp_csv = "canopycovertraits.csv"
         csv_file = open(tmp_csv, 'w')
@@ -63,26 +74,25 @@ class CanopyCoverHeight(TerrarefExtractor):
         logging.info(resource)
         ds_info = get_info(connector, host, secret_key, resource['parent']['id'])
         timestamp = ds_info['name'].split(" - ")[1]
-        all_plots = get_site_boundaries(timestamp, city='Maricopa')
+        with timer.stage('plot_boundaries'):
+            all_plots = self.plot_cache.site_boundaries(timestamp, city='Maricopa')
 
+        # Read the full field once and get every plot's cover from a single label image
+        with timer.stage('zonal_stats', os.path.getsize(resource['local_paths'][0])):
+            cc_by_plot = zonal_stats.canopy_cover_by_plot(resource['local_paths'][0], all_plots, 5,
+                                                          workers=self.plot_workers, cache=self.plot_cache)
+        logging.info("computed canopy cover for %s/%s plots" % (len(cc_by_plot), len(all_plots)))
+
+        datapoints = geostreams_batch.DatapointBatch(connector, host, secret_key, "Canopy Cover",
+                                                     self.args.geostreams_workers, self.args.geostreams_batch)
         successful_plots = 0
-        for plotname in all_plots:
+        for plotname in sorted(all_plots):
             bounds = all_plots[plotname]
-
-            # Use GeoJSON string to clip full field to this plot
-            try:
-                (pxarray, geotrans) = clip_raster(resource['local_paths'][0], bounds)
-                if len(pxarray.shape) < 3:
-                    logging.error("unexpected array shape for %s (%s)" % (plotname, pxarray.shape))
-                    continue
-                ccVal = ccCore.gen_cc_for_img(rollaxis(pxarray,0,3), 5)
-                ccVal *= 100.0 # Make 0-100 instead of 0-1
-                successful_plots += 1
-                if successful_plots % 10 == 0:
-                    logging.info("processed %s/%s plots successfully" % (successful_plots, len(all_plots)))
-            except:
-                logging.error("error generating cc for %s" % plotname)
+            if plotname not in cc_by_plot:
+                logging.error("no pixels of %s in the field mosaic" % plotname)
                 continue
+            ccVal = cc_by_plot[plotname] * 100.0 # Make 0-100 instead of 0-1
+            successful_plots += 1
 
             traits['canopy_cover'] = str(ccVal)
             traits['site'] = plotname
@@ -91,29 +101,34 @@ class CanopyCoverHeight(TerrarefExtractor):
 
             csv_file.write(','.join(map(str, trait_list)) + '\n')
 
-            # Prepare and submit datapoint
+            # Prepare datapoint; they are submitted together below
             centroid_lonlat = json.loads(centroid_from_geojson(bounds))["coordinates"]
             time_fmt = timestamp+"T12:00:00-07:00"
             dpmetadata = {
                 "source": host + ("" if host.endswith("/") else "/") + "files/" + resource['id'],
                 "canopy_cover": ccVal
             }
-            create_datapoint_with_dependencies(connector, host, secret_key, "Canopy Cover",
-                                               (centroid_lonlat[1], centroid_lonlat[0]), time_fmt, time_fmt,
-                                               dpmetadata, timestamp)
+            datapoints.add((centroid_lonlat[1], centroid_lonlat[0]), time_fmt, time_fmt, dpmetadata, timestamp)
+
+        with timer.stage('geostreams'):
+            datapoints.flush()
 
         # submit CSV to BETY
         csv_file.close()
-        submit_traits(tmp_csv, betykey=self.bety_key)
+        with timer.stage('bety_submit', os.path.getsize(tmp_csv)):
+            submit_traits(tmp_csv, betykey=self.bety_key)
 
         # Add metadata to original dataset indicating this was run
         ext_meta = build_metadata(host, self.extractor_info, resource['parent']['id'], {
             "plots_processed": successful_plots,
             "plots_skipped": len(all_plots)-successful_plots,
-            "betydb_link": "https://terraref.ncsa.illinois.edu/bety/api/beta/variables?name=canopy_cover"
+            "betydb_link": "https://terraref.ncsa.illinois.edu/bety/api/beta/variables?name=canopy_cover",
+            "stage_timings": timer.summary(pending=['metadata_post'])
         }, 'dataset')
-        upload_metadata(connector, host, secret_key, resource['parent']['id'], ext_meta)
+        with timer.stage('metadata_post'):
+            upload_metadata(connector, host, secret_key, resource['parent']['id'], ext_meta)
 
+        timer.write(self.args.timing_log)
         self.end_message()
 
 if __name__ == "__main__":
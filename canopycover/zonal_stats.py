@@ -0,0 +1,108 @@
+'''
+Per-plot canopy cover for a whole field mosaic in one sequential read.
+
+Instead of one clip_raster call (and one raster open) per plot, every plot
+polygon is burned into an integer label image and the plant mask of the
+field is computed once; each plot's ratio then comes out of a single
+np.bincount over (label, mask) pairs. Rows are processed in blocks with a
+halo of half the blur window so the blur sees the same neighbours as on the whole image.
+
+Given a plot_cache.PlotCache, the label image comes from the cache (see
+plot_labels.cached_label_image) as a memory-mapped .npy instead.
+'''
+
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+
+import canopyCover as ccCore
+from plot_labels import plot_label_layer, rasterize_labels, raster_grid, cached_label_image
+
+# Rows per block read from the raster
+BLOCK_ROWS = 1024
+
+
+def canopy_cover_by_plot(rast_path, plots, kernelSize=5, block_rows=BLOCK_ROWS, workers=1, cache=None):
+    """
+    Canopy cover ratio (0-1) of every plot in an RGB GeoTIFF/VRT.
+
+    plots is a dict of plot name -> GeoJSON geometry string, as returned by
+    terrautils.betydb.get_site_boundaries. Returns {plot name: ratio} for the
+    plots that cover at least one pixel centre of the raster.
+
+    With workers > 1 the row blocks are spread over a process pool. Each
+    worker opens the raster read-only once and they share it through the
+    page cache; the integer counts are summed, so the result does not depend
+    on the number of workers.
+    """
+    rast = gdal.Open(rast_path)
+    grid = raster_grid(rast)
+    ysize = rast.RasterYSize
+    rast = None
+    names = sorted(plots.keys())
+    labels_path = cached_label_image(cache, plots, names, grid)
+
+    if workers > 1:
+        # enough blocks to keep every worker busy
+        block_rows = min(block_rows, max(64, -(-ysize // workers)))
+    blocks = [(top, min(top + block_rows, ysize)) for top in range(0, ysize, block_rows)]
+    init_args = (rast_path, plots, names, kernelSize, labels_path)
+
+    if workers > 1 and len(blocks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(blocks)), _init_worker, init_args)
+        try:
+            parts = pool.map(_count_block, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        try:
+            parts = [_count_block(block) for block in blocks]
+        finally:
+            _worker.clear()
+
+    # counts[label] = (non-plant pixels, plant pixels); label 0 is outside every plot
+    counts = np.zeros((len(names)+1, 2), dtype=np.int64)
+    for part in parts:
+        counts += part
+
+    totals = counts.sum(axis=1)
+    return dict((name, counts[label, 1]/float(totals[label]))
+                for label, name in enumerate(names, 1) if totals[label] > 0)
+
+
+# Per-process raster handle and plot layer; GDAL datasets and OGR layers
+# must not be shared between workers
+_worker = {}
+
+def _init_worker(rast_path, plots, names, kernelSize, labels_path=None):
+    rast = gdal.Open(rast_path)
+    _worker.update(rast=rast, labels=len(names)+1, kernelSize=kernelSize)
+    if labels_path:
+        _worker['label_image'] = np.load(labels_path, mmap_mode='r')
+    else:
+        source, layer = plot_label_layer(plots, names, rast.GetProjection())
+        _worker.update(source=source, layer=layer)
+
+
+def _count_block(block):
+    # (label, plant) pixel counts of raster rows [top, bottom)
+    top, bottom = block
+    rast, kernelSize = _worker['rast'], _worker['kernelSize']
+    xsize, ysize = rast.RasterXSize, rast.RasterYSize
+    read_top = max(top - kernelSize//2, 0)
+    read_bottom = min(bottom + kernelSize//2, ysize)
+
+    pixels = rast.ReadAsArray(0, read_top, xsize, read_bottom - read_top)
+    pixels = np.rollaxis(pixels[:3], 0, 3)
+    mask = ccCore.gen_cc_mask(pixels, kernelSize)[top-read_top:bottom-read_top]
+    del pixels
+
+    if 'label_image' in _worker:
+        labels = _worker['label_image'][top:bottom]
+    else:
+        labels = rasterize_labels(_worker['layer'], rast.GetGeoTransform(), rast.GetProjection(),
+                                  xsize, top, bottom - top)
+    pairs = (labels.astype(np.int64) << 1) | mask
+    return np.bincount(pairs.ravel(), minlength=2*_worker['labels']).reshape(-1, 2)
@@ -0,0 +1,154 @@
+'''
+Bilinear demosaic of the GT3300C BayerGR8 frames (G R / B G 2x2 cells).
+
+This is the fixed-point replacement for the plane + scipy convolve demosaic
+that used to live in bin_to_geotiff, canopyCover and stereo_match. Every
+output pixel is the same integer result the float kernels produced, but the
+work is done with strided slices of the raw frame and uint16 accumulators,
+written straight into a caller supplied RGB buffer.
+
+The module is copied into each extractor directory that demosaics raw frames;
+keep the copies identical.
+'''
+
+import numpy as np
+
+R, G, B = 0, 1, 2
+
+# Original convolution kernels (x4), as (row offset, column offset, weight)
+_KERNEL_G = [(-1, 0, 1), (0, -1, 1), (0, 0, 4), (0, 1, 1), (1, 0, 1)]
+_KERNEL_RB = [(-1, -1, 1), (-1, 0, 2), (-1, 1, 1),
+              (0, -1, 2), (0, 0, 4), (0, 1, 2),
+              (1, -1, 1), (1, 0, 2), (1, 1, 1)]
+
+# Per site parity (row % 2, col % 2): the channel sampled at the site, then the
+# (channel, taps, shift) entries interpolated there as sum(taps) >> shift.
+_SITES = {
+    (0, 0): (G, [(R, [(0, -1), (0, 1)], 1),
+                 (B, [(-1, 0), (1, 0)], 1)]),
+    (0, 1): (R, [(G, [(-1, 0), (1, 0), (0, -1), (0, 1)], 2),
+                 (B, [(-1, -1), (-1, 1), (1, -1), (1, 1)], 2)]),
+    (1, 0): (B, [(G, [(-1, 0), (1, 0), (0, -1), (0, 1)], 2),
+                 (R, [(-1, -1), (-1, 1), (1, -1), (1, 1)], 2)]),
+    (1, 1): (G, [(R, [(-1, 0), (1, 0)], 1),
+                 (B, [(0, -1), (0, 1)], 1)]),
+}
+
+
+def read_frame(in_file, shape):
+    """
+    Memory-map a raw BayerGR8 .bin frame without copying it.
+
+    shape is (width, height) as given by the capture metadata; the returned
+    read-only array is (height, width).
+    """
+    return np.memmap(in_file, dtype=np.uint8, mode='r', shape=(shape[1], shape[0]))
+
+
+def demosaic(im, out=None):
+    """
+    Demosaic a 2D uint8 Bayer frame into an (rows, cols, 3) uint8 RGB array.
+
+    If out is given it must be a writable (rows, cols, 3) uint8 array; any view
+    works, so callers can pass a rotated or strided view of their own buffer.
+    """
+    im = np.asarray(im, dtype=np.uint8)
+    h, w = im.shape
+    if out is None:
+        out = np.empty((h, w, 3), dtype=np.uint8)
+
+    if h < 3 or w < 3:
+        out[...] = _demosaic_block(im)
+        return out
+
+    acc = np.empty(((h + 1) // 2, (w + 1) // 2), dtype=np.uint16)
+    for (pr, pc), (own, interpolated) in _SITES.items():
+        out[pr::2, pc::2, own] = im[pr::2, pc::2]
+
+        r0, c0 = (1 if pr else 2), (1 if pc else 2)
+        for channel, taps, shift in interpolated:
+            dst = out[r0:h-1:2, c0:w-1:2, channel]
+            buf = acc[:dst.shape[0], :dst.shape[1]]
+            views = [im[r0+dr:h-1+dr:2, c0+dc:w-1+dc:2] for dr, dc in taps]
+            np.add(views[0], views[1], out=buf, dtype=np.uint16)
+            for v in views[2:]:
+                buf += v
+            buf >>= shift
+            dst[...] = buf
+
+    _fix_border(im, out)
+    return out
+
+
+def demosaic_rot90(im, out=None):
+    """
+    Demosaic straight into the np.rot90 orientation used for the JPG/TIF
+    outputs, i.e. a C-contiguous (cols, rows, 3) buffer, so the rotated
+    image is never materialised as a second copy.
+    """
+    h, w = im.shape
+    if out is None:
+        out = np.empty((w, h, 3), dtype=np.uint8)
+    demosaic(im, out=np.rot90(out, -1))
+    return out
+
+
+def demosaic_rows(im, start, stop, out=None):
+    """
+    Demosaic rows [start, stop) of a full Bayer frame into (stop-start, cols, 3).
+
+    Only those rows and a one row halo are read (two rows above, to keep the
+    Bayer phase), so a memory-mapped frame can be converted strip by strip.
+    start must be even. The result equals demosaic(im)[start:stop].
+    """
+    h, w = im.shape
+    if start % 2:
+        raise ValueError('strip must start on an even row, got %d' % start)
+    stop = min(stop, h)
+    top = max(start - 2, 0)
+    bottom = min(stop + 1, h)
+    # halo rows are demosaiced with a reflected border and dropped
+    rows = demosaic(im[top:bottom])[start-top:stop-top]
+    if out is None:
+        return rows
+    out[...] = rows
+    return out
+
+
+def _fix_border(im, out):
+    # Edge pixels see the reflected frame, which does not follow the Bayer
+    # pattern, so recompute them exactly on thin even-aligned edge blocks.
+    h, w = im.shape
+    last_r = (h - 3) & ~1
+    last_c = (w - 3) & ~1
+    out[0] = _demosaic_block(im[0:3])[0]
+    out[h-1] = _demosaic_block(im[last_r:h])[-1]
+    out[:, 0] = _demosaic_block(im[:, 0:3])[:, 0]
+    out[:, w-1] = _demosaic_block(im[:, last_c:w])[:, -1]
+
+
+def _demosaic_block(im):
+    """
+    Integer form of the original per-plane convolution with scipy's default
+    'reflect' border. The block must start on an even row and column.
+
+    Bright edge pixels overflow 255 under reflection; they are wrapped to
+    uint8 exactly as the float kernels cast them.
+    """
+    h, w = im.shape
+    rows = (np.arange(h) % 2)[:, None]
+    cols = (np.arange(w) % 2)[None, :]
+    planes = ((R, (rows == 0) & (cols == 1), _KERNEL_RB),
+              (G, rows == cols, _KERNEL_G),
+              (B, (rows == 1) & (cols == 0), _KERNEL_RB))
+
+    block = np.empty((h, w, 3), dtype=np.uint8)
+    acc = np.empty((h, w), dtype=np.uint16)
+    for channel, mask, kernel in planes:
+        plane = np.pad(np.where(mask, im, 0).astype(np.uint16), 1, mode='symmetric')
+        acc[...] = 0
+        for dr, dc, weight in kernel:
+            acc += weight * plane[1+dr:1+dr+h, 1+dc:1+dc+w]
+        acc >>= 2
+        block[:, :, channel] = acc.astype(np.uint8)
+    return block
@@ -28,6 +28,10 @@ def options():
     parser.add_argument("-i", "--in_dir", help="input, stereo top bin files parent directory")
     parser.add_argument("-o", "--out_dir", help="output parent directory")
     parser.add_argument("-d", "--date", help="scan date")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes for binary to image conversion")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep existing output and only convert captures without TIFFs")
 
     args = parser.parse_args()
 
@@ -41,18 +45,17 @@ def main():
     if not path.isdir(in_dir) or not path.isdir(args.out_dir):
         return
     
-    subdirs = listdir(in_dir)
-    
     TILE_FOLDER_NAME = 'tiles_' + args.date
 
     # Create a file to write the paths for all of the TIFFs. This will be used create the VRT.
     tif_file_list = path.join(out_dir,'tif_list.txt')
     
     # If there is a pre-existing tiles folder with this name, delete it (failing to do so can result in some weirdness when you load tiles later)
-    if path.exists(out_dir):
+    if path.exists(out_dir) and not args.resume:
         rmtree(out_dir)
     
-    makedirs(out_dir)
+    if not path.exists(out_dir):
+        makedirs(out_dir)
     
     if path.exists(tif_file_list):
         try:
@@ -62,13 +65,7 @@ def main():
 
     # Convert binary files that are within GPS bounds to JPGs and GeoTIFFs
     print "Starting binary to image conversion..."
-    for subdir in subdirs:
-        in_path = path.join(in_dir, subdir)
-        out_path = path.join(out_dir, subdir)
-        try:
-            bin_to_geotiff.main(in_path,out_path,tif_file_list, GPS_BOUNDS)
-        except Exception as ex:
-            fail("\tFailed to process folder %s: %s" % (in_path, str(ex)))
+    bin_to_geotiff.process_day(in_dir, out_dir, tif_file_list, GPS_BOUNDS, args.processes, resume=args.resume)
     print "Completed binary to image conversion..."
     print "Found " + str(file_len(tif_file_list)) + " folders within GPS bounds."
     
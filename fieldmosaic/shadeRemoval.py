@@ -260,22 +260,21 @@ def main():
     
     return
 
-def create_tif_list(in_dir, out_dir):
+def create_tif_list(in_dir, out_dir, processes=None, resume=False):
     
     if not os.path.isdir(in_dir):
         return
-    
-    subdirs = os.listdir(in_dir)
 
     # Create a file to write the paths for all of the TIFFs. This will be used create the VRT.
     tif_file_list = os.path.join(out_dir,'tif_list.txt')
     
     
     # If there is a pre-existing tiles folder with this name, delete it (failing to do so can result in some weirdness when you load tiles later)
-    if os.path.exists(out_dir):
+    if os.path.exists(out_dir) and not resume:
         shutil.rmtree(out_dir)
     
-    os.makedirs(out_dir)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
     
     if os.path.exists(tif_file_list):
         try:
@@ -285,13 +284,7 @@ def create_tif_list(in_dir, out_dir):
 
     # Convert binary files that are within GPS bounds to JPGs and GeoTIFFs
     print "Starting binary to image conversion..."
-    for subdir in subdirs:
-        in_path = os.path.join(in_dir, subdir)
-        out_path = os.path.join(out_dir, subdir)
-        try:
-            bin_to_geotiff.main(in_path,out_path,tif_file_list, GPS_BOUNDS)
-        except Exception as ex:
-            fail("\tFailed to process folder %s: %s" % (in_path, str(ex)))
+    bin_to_geotiff.process_day(in_dir, out_dir, tif_file_list, GPS_BOUNDS, processes, resume=resume)
     print "Completed binary to image conversion..."
     print "Found " + str(file_len(tif_file_list)) + " folders within GPS bounds."
     
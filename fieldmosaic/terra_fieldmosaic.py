@@ -13,10 +13,12 @@ from terrautils.extractors import TerrarefExtractor, build_metadata, build_datas
 
 import full_day_to_tiles
 import shadeRemoval as shade
+import stage_timer
 
 
 def add_local_arguments(parser):
     # add any additional arguments to parser
+    stage_timer.add_arguments(parser)
     parser.add_argument('--darker', type=bool, default=os.getenv('MOSAIC_DARKER', False),
                              help="whether to use multipass mosiacking to select darker pixels")
     parser.add_argument('--split', type=int, default=os.getenv('MOSAIC_SPLIT', 2),
@@ -40,6 +42,7 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
 
     def process_message(self, connector, host, secret_key, resource, parameters):
         self.start_message(resource)
+        timer = stage_timer.StageTimer(self.extractor_info['name'], resource['id'])
 
         if type(parameters) is str:
             parameters = json.loads(parameters)
@@ -76,18 +79,19 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
         if not self.darker or sensor_type != 'rgb':
             (nu_created, nu_bytes) = self.generateSingleMosaic(connector, host, secret_key, sensor_type,
                                                                out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters,
-                                                               resource)
+                                                               resource, timer)
         else:
             (nu_created, nu_bytes) = self.generateDarkerMosaic(connector, host, secret_key, sensor_type,
                                                                out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters,
-                                                               resource)
+                                                               resource, timer)
         self.created += nu_created
         self.bytes += nu_bytes
 
         # Get dataset ID or create it, creating parent collections as needed
-        target_dsid = build_dataset_hierarchy(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
-                                              self.sensors.get_display_name(), timestamp[:4],
-                                              timestamp[5:7], leaf_ds_name=dataset_name)
+        with timer.stage('dataset_hierarchy'):
+            target_dsid = build_dataset_hierarchy(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                                  self.sensors.get_display_name(), timestamp[:4],
+                                                  timestamp[5:7], leaf_ds_name=dataset_name)
 
         # Upload full field image to Clowder
         content = {
@@ -98,20 +102,20 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
             "file_ids": parameters["file_paths"]
         }
 
-        if os.path.exists(out_tif_thumb):
-            thumbid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid, out_tif_thumb)
-            thumbmeta = build_metadata(host, self.extractor_info, thumbid, content, 'file')
-            upload_metadata(connector, host, secret_key, thumbid, thumbmeta)
-
-        if os.path.exists(out_tif_full):
-            fullid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid, out_tif_full)
-            fullmeta = build_metadata(host, self.extractor_info, fullid, content, 'file')
-            upload_metadata(connector, host, secret_key, fullid, fullmeta)
+        for out_tif in [out_tif_thumb, out_tif_full]:
+            if os.path.exists(out_tif):
+                with timer.stage('upload', os.path.getsize(out_tif)):
+                    fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, target_dsid, out_tif)
+                content["stage_timings"] = timer.summary(pending=['metadata_post'])
+                filemeta = build_metadata(host, self.extractor_info, fileid, content, 'file')
+                with timer.stage('metadata_post'):
+                    upload_metadata(connector, host, secret_key, fileid, filemeta)
 
+        timer.write(self.args.timing_log)
         self.end_message(resource)
 
     def generateSingleMosaic(self, connector, host, secret_key, sensor_type,
-                             out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters, resource):
+                             out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters, resource, timer):
         # Create simple mosaic from geotiff list
         created, bytes = 0, 0
 
@@ -130,7 +134,9 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
 
             # Create VRT from every GeoTIFF
             self.log_info(resource, "Creating %s..." % out_vrt)
-            full_day_to_tiles.createVrtPermanent(out_dir, tiflist, out_vrt)
+            with timer.stage('vrt_build') as st:
+                full_day_to_tiles.createVrtPermanent(out_dir, tiflist, out_vrt)
+                st.bytes += os.path.getsize(out_vrt)
             os.remove(tiflist)
             created += 1
             bytes += os.path.getsize(out_vrt)
@@ -145,7 +151,9 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
 
             cmd = "gdal_translate -projwin -111.9750963 33.0764953 -111.9747967 33.074485715 " + \
                     "-outsize %s%% %s%% %s %s" % (pct, pct, out_vrt, out_tif_thumb)
-            subprocess.call(cmd, shell=True)
+            with timer.stage('translate') as st:
+                subprocess.call(cmd, shell=True)
+                st.bytes += os.path.getsize(out_tif_thumb)
             created += 1
             bytes += os.path.getsize(out_tif_thumb)
 
@@ -162,7 +170,7 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
         return (created, bytes)
 
     def generateDarkerMosaic(self, connector, host, secret_key, sensor_type,
-                             out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters, resource):
+                             out_dir, out_vrt, out_tif_thumb, out_tif_full, parameters, resource, timer):
         # Create dark-pixel mosaic from geotiff list using multipass for darker pixel selection
         created, bytes = 0, 0
 
@@ -181,7 +189,9 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
 
             # Create VRT from every GeoTIFF
             self.log_info(resource, "Creating %s..." % out_vrt)
-            full_day_to_tiles.createVrtPermanent(out_dir, tiflist, out_vrt)
+            with timer.stage('vrt_build') as st:
+                full_day_to_tiles.createVrtPermanent(out_dir, tiflist, out_vrt)
+                st.bytes += os.path.getsize(out_vrt)
             created += 1
             bytes += os.path.getsize(out_vrt)
 
@@ -189,19 +199,22 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
             shade.split_tif_list(tiflist, out_dir, self.split)
 
             # Generate tiles from each split VRT into numbered folders
-            shade.create_diff_tiles_set(out_dir, self.split)
+            with timer.stage('split_tiles'):
+                shade.create_diff_tiles_set(out_dir, self.split)
 
             # Choose darkest pixel from each overlapping tile
             unite_tiles_dir = os.path.join(out_dir, 'unite')
             if not os.path.exists(unite_tiles_dir):
                 os.mkdir(unite_tiles_dir)
-            shade.integrate_tiles(out_dir, unite_tiles_dir, self.split)
+            with timer.stage('integrate_tiles'):
+                shade.integrate_tiles(out_dir, unite_tiles_dir, self.split)
 
-            # If any files didn't have overlap, copy individual tile
-            shade.copy_missing_tiles(out_dir, unite_tiles_dir, self.split, tiles_folder_name='tiles_left')
+                # If any files didn't have overlap, copy individual tile
+                shade.copy_missing_tiles(out_dir, unite_tiles_dir, self.split, tiles_folder_name='tiles_left')
 
             # Create output VRT from overlapped tiles
-            shade.create_unite_tiles(unite_tiles_dir, out_vrt)
+            with timer.stage('vrt_build'):
+                shade.create_unite_tiles(unite_tiles_dir, out_vrt)
             created += 1
             bytes += os.path.getsize(out_vrt)
 
@@ -213,8 +226,10 @@ class FullFieldMosaicStitcher(TerrarefExtractor):
             else:
                 pct = '2'
 
-            subprocess.call("gdal_translate -projwin -111.9750963 33.0764953 -111.9747967 33.074485715 "+
-                             "-outsize %s%% %s%% %s %s" % (pct, pct, out_vrt, out_tif_thumb), shell=True)
+            with timer.stage('translate') as st:
+                subprocess.call("gdal_translate -projwin -111.9750963 33.0764953 -111.9747967 33.074485715 "+
+                                 "-outsize %s%% %s%% %s %s" % (pct, pct, out_vrt, out_tif_thumb), shell=True)
+                st.bytes += os.path.getsize(out_tif_thumb)
             created += 1
             bytes += os.path.getsize(out_tif_thumb)
 
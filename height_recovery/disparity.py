@@ -0,0 +1,120 @@
+'''
+Semi-global block matching disparity of rectified stereo pairs, optionally
+split into horizontal strips computed on a thread pool.
+
+    disp = disparity.compute_disparity(imgL, imgR, min_disp, num_disp, strips=4)
+
+cv2.StereoSGBM.compute releases the GIL, so strips run concurrently on
+threads. Each strip is matched with `overlap` extra rows above and below,
+which are dropped when the strips are stitched back together. SGBM
+aggregates costs along paths that run the whole image, so the stitched
+result can still differ slightly from one call over the whole pair;
+strip_difference measures by how much.
+'''
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import cv2
+
+# Matching parameters of the stereoTop height recovery
+WINDOW_SIZE = 9
+# Rows matched above and below each strip and then discarded
+OVERLAP = 64
+# Disparities kept by the height recovery, exclusive; the full search is minDisparity 1, 320 levels
+KEEP_DISP = (132, 320)
+# Plant heights (mm above the ground) the adaptive search covers: the height histogram range
+HEIGHT_RANGE = (0, 3200)
+
+
+def create_sgbm(min_disp, num_disp, window_size=WINDOW_SIZE):
+    """StereoSGBM matcher with the stereoTop parameters; num_disp must be a multiple of 16."""
+    return cv2.StereoSGBM_create(minDisparity=min_disp,
+                                 numDisparities=num_disp,
+                                 blockSize=window_size,
+                                 P1=8*window_size*window_size,
+                                 P2=32*window_size*window_size,
+                                 disp12MaxDiff=3,
+                                 uniquenessRatio=2,
+                                 speckleWindowSize=50,
+                                 speckleRange=3,
+                                 mode=cv2.STEREO_SGBM_MODE_SGBM)
+
+
+def compute_disparity(imgL, imgR, min_disp, num_disp, strips=1, overlap=OVERLAP, window_size=WINDOW_SIZE):
+    """
+    Disparity in pixels (float32) of a rectified pair, 0 where unmatched, as
+    one SGBM call or, with strips > 1, as that many horizontal strips matched
+    on threads.
+    """
+    rows = imgL.shape[0]
+    strips = max(1, min(strips, rows // max(1, overlap)))
+    if strips == 1:
+        return _match(imgL, imgR, min_disp, num_disp, window_size)
+
+    bounds = [(rows*i//strips, rows*(i+1)//strips) for i in range(strips)]
+    disp = np.empty(imgL.shape[:2], dtype=np.float32)
+
+    def match_strip(bound):
+        top, bottom = bound
+        read_top, read_bottom = max(top - overlap, 0), min(bottom + overlap, rows)
+        strip = _match(imgL[read_top:read_bottom], imgR[read_top:read_bottom], min_disp, num_disp, window_size)
+        disp[top:bottom] = strip[top-read_top:bottom-read_top]
+
+    pool = ThreadPool(strips)
+    try:
+        pool.map(match_strip, bounds)
+    finally:
+        pool.close()
+        pool.join()
+    return disp
+
+
+def strip_difference(imgL, imgR, min_disp, num_disp, strips, overlap=OVERLAP, window_size=WINDOW_SIZE):
+    """
+    Compare the strip-parallel disparity with a single SGBM call on the same
+    pair. Returns the fraction of pixels whose validity differs, and the
+    fraction of pixels valid in both that differ by more than one pixel and
+    their mean absolute difference.
+    """
+    single = compute_disparity(imgL, imgR, min_disp, num_disp, 1, overlap, window_size)
+    stitched = compute_disparity(imgL, imgR, min_disp, num_disp, strips, overlap, window_size)
+    valid_single, valid_stitched = single >= min_disp, stitched >= min_disp
+    both = valid_single & valid_stitched
+    diff = np.abs(single[both] - stitched[both])
+    return {"validity_changed": float((valid_single != valid_stitched).mean()),
+            "over_1px": float((diff > 1).mean()) if diff.size else 0.0,
+            "mean_abs": float(diff.mean()) if diff.size else 0.0}
+
+
+def disparity_window(camera_height, focal_length, baseline, height_range=HEIGHT_RANGE, keep=KEEP_DISP, margin=2):
+    """
+    (min_disp, num_disp) of an SGBM search covering the disparities of points
+    height_range[0] to height_range[1] mm above the ground, seen from a camera
+    camera_height mm above it (disparity = focal_length * baseline / distance),
+    within the kept disparities and margin levels beyond them. num_disp is a
+    multiple of 16, and the search never goes above the full one.
+    """
+    low, high = keep
+    top = camera_height - height_range[1]
+    if top > 0:
+        high = min(high, focal_length*baseline/top)
+    low = max(low, focal_length*baseline/max(camera_height - height_range[0], 1))
+    if low >= high:
+        low, high = keep
+
+    full_max = keep[1]
+    min_disp = max(1, int(np.floor(low)) - margin)
+    max_disp = min(full_max, int(np.ceil(high)) + margin)
+    num_disp = -(-(max_disp - min_disp + 1) // 16)*16
+    min_disp = max(1, min(min_disp, full_max + 1 - num_disp))
+    return min_disp, num_disp
+
+
+def _match(imgL, imgR, min_disp, num_disp, window_size):
+    # a matcher per call: StereoSGBM keeps its work buffers in the object
+    stereo = create_sgbm(min_disp, num_disp, window_size)
+    disp = stereo.compute(imgL, imgR)
+    # unmatched pixels are (min_disp - 1)*16; make them 0 whatever the window,
+    # as with the full search, so they never pass a disparity threshold
+    disp = np.where(disp < min_disp*16, 0, disp)
+    return disp.astype(np.float32) / 16.0
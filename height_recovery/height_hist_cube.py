@@ -0,0 +1,130 @@
+'''
+Per-day store of the plot height histograms of every capture, replacing the
+<plot>.npy file per plot per capture.
+
+All captures of a day append to one file of fixed-size records, one record
+per (capture, plot) holding the HIST_BINS bin counts, so a day is a single
+file on the shared file system rather than thousands of small ones:
+
+    cube = HeightHistCube(os.path.join(out_dir, CUBE_FILE))
+    cube.commit(capture, plotNum, hists)     # from each capture, any process
+    heightHist = cube.day_hist()             # (PLOT_COUNT, HIST_BINS) sums
+
+A capture's records are written with one append under an exclusive lock and
+the last of them is flagged, so a commit is all or nothing: readers ignore a
+torn tail left by a crashed writer, and the next writer truncates it. A
+writer only reads the tail of the file, so a capture committed twice (e.g.
+by two runs over the same day) is stored twice; readers keep its first
+commit. full_day_stereo_to_height skips captures already committed.
+
+A capture without plots in view is committed as one EMPTY_PLOT record with
+a zero histogram, so that it is still recorded as done.
+'''
+
+import os, fcntl
+import numpy as np
+
+CUBE_FILE = 'heightHist.rec'
+PLOT_COUNT = 1728
+HIST_BINS = 400
+
+RECORD = np.dtype([('capture', 'S64'), ('plot', '<i4'), ('last', 'u1'), ('hist', '<u4', (HIST_BINS,))])
+# plot number of the marker record of a capture with no plots
+EMPTY_PLOT = -1
+# Records read at a time when looking back from the end of the file for the last commit
+TAIL_RECORDS = 256
+
+
+class HeightHistCube(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def commit(self, capture, plots, hists):
+        """Append the (len(plots), HIST_BINS) histograms of one capture, or its EMPTY_PLOT marker if it has none."""
+        if len(capture.encode('utf-8')) > RECORD['capture'].itemsize:
+            raise ValueError("capture name longer than %d bytes: %s" % (RECORD['capture'].itemsize, capture))
+        records = np.zeros(max(len(plots), 1), dtype=RECORD)
+        records['capture'] = capture
+        if len(plots):
+            records['plot'] = plots
+            records['hist'] = np.asarray(hists).reshape(len(plots), HIST_BINS)
+        else:
+            records['plot'] = EMPTY_PLOT
+        records['last'][-1] = 1
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # drop any torn tail, then append the whole capture at once
+            end = self._committed_count(fd)*RECORD.itemsize
+            if end != os.fstat(fd).st_size:
+                os.ftruncate(fd, end)
+            os.lseek(fd, end, os.SEEK_SET)
+            data = records.tobytes()
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def records(self):
+        """
+        The committed records, memory-mapped read-only; only the first commit
+        of each capture. Captures with no plots have one EMPTY_PLOT record.
+        """
+        if not os.path.exists(self.path):
+            return np.zeros(0, dtype=RECORD)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            count = self._committed_count(fd)
+        finally:
+            os.close(fd)
+        if count == 0:
+            return np.zeros(0, dtype=RECORD)
+        return _first_commits(np.memmap(self.path, dtype=RECORD, mode='r', shape=(count,)))
+
+    def captures(self):
+        return set(c.decode('utf-8') for c in self.records()['capture'])
+
+    def day_hist(self, plot_count=PLOT_COUNT):
+        """(plot_count, HIST_BINS) histograms summed over all captures; row plot-1 is plot number plot."""
+        records = self.records()
+        records = records[records['plot'] > 0]
+        heightHist = np.zeros((plot_count, HIST_BINS))
+        np.add.at(heightHist, records['plot'] - 1, records['hist'])
+        return heightHist
+
+    def _committed_count(self, fd):
+        # Records up to and including the last one that ends a commit, reading back
+        # from the end of the file only as far as that record
+        end = os.fstat(fd).st_size // RECORD.itemsize
+        while end > 0:
+            start = max(0, end - TAIL_RECORDS)
+            os.lseek(fd, start*RECORD.itemsize, os.SEEK_SET)
+            data = b''
+            while len(data) < (end - start)*RECORD.itemsize:
+                chunk = os.read(fd, (end - start)*RECORD.itemsize - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            last = np.frombuffer(data, dtype=RECORD, count=len(data) // RECORD.itemsize)['last']
+            ends = np.flatnonzero(last)
+            if len(ends):
+                return start + ends[-1] + 1
+            end = start
+        return 0
+
+
+def _first_commits(records):
+    # Drop the records of every commit of a capture but its first
+    ends = np.flatnonzero(records['last'])
+    captures = records['capture'][ends]
+    _, first = np.unique(captures, return_index=True)
+    if len(first) == len(ends):
+        return records
+    keep = np.zeros(len(ends), dtype=bool)
+    keep[first] = True
+    sizes = np.diff(np.concatenate(([-1], ends)))
+    return records[np.repeat(keep, sizes)]
@@ -3,13 +3,16 @@ Created on Mar 21, 2017
 
 @author: Zongyang
 '''
-import os, sys, calibration, json, argparse
+import os, sys, calibration, json, argparse, multiprocessing
 import numpy as np
-from PIL import Image, ImageFilter
+from PIL import Image
 import matplotlib.pyplot as plt
 from glob import glob
 import terra_common
-from scipy.ndimage.filters import convolve
+from bayer import demosaic, read_frame
+import box_filter
+import height_hist_cube
+import disparity
 from scipy.stats.stats import pearsonr
 import cv2
 from datetime import date
@@ -20,12 +23,14 @@ def main():
     args = options()
 
     if args.mode == 'one':
-        full_day_stereo_to_height(args.calib_dir, args.in_dir, args.out_dir)
+        full_day_stereo_to_height(args.calib_dir, args.in_dir, args.out_dir, args.processes, args.strips,
+                                  parse_height_range(args.height_range))
             
         stereo_height_data_integrate_per_day(args.out_dir, args.out_dir)
         
     if args.mode == 'date':
-        process_one_month_data(args.calib_dir, args.in_dir, args.out_dir)
+        process_one_month_data(args.calib_dir, args.in_dir, args.out_dir, args.processes, args.strips,
+                               parse_height_range(args.height_range))
     
     return
     '''
@@ -62,12 +67,25 @@ def options():
     parser.add_argument("-i", "--in_dir", help="input directory")
     parser.add_argument("-o", "--out_dir", help="output directory")
     parser.add_argument("-c", "--calib_dir", help="calibration directory")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes for the captures of a day")
+    parser.add_argument("-s", "--strips", type=int, default=1,
+                        help="horizontal strips each disparity image is matched in, on as many threads")
+    parser.add_argument("-e", "--height_range", default='%d,%d' % disparity.HEIGHT_RANGE,
+                        help="plant heights in mm, 'min,max', whose disparities are searched; 'full' searches 1-320")
 
     args = parser.parse_args()
 
     return args
 
-def process_one_month_data(calib_dir, in_dir, out_dir):
+def parse_height_range(text):
+    
+    # 'min,max' in mm, or 'full' for the whole disparity search
+    if text == 'full':
+        return None
+    return tuple(float(v) for v in text.split(','))
+
+def process_one_month_data(calib_dir, in_dir, out_dir, processes=1, strips=1, height_range=disparity.HEIGHT_RANGE):
     
     for day in range(11, 21):
         target_date = date(2016, int(10), day)
@@ -78,7 +96,7 @@ def process_one_month_data(calib_dir, in_dir, out_dir):
         if not os.path.isdir(in_path):
             continue
         try:
-            full_day_stereo_to_height(calib_dir, in_path, out_path)
+            full_day_stereo_to_height(calib_dir, in_path, out_path, processes, strips, height_range)
     
             stereo_height_data_integrate_per_day(out_path, out_path)
         except Exception as ex:
@@ -175,39 +193,103 @@ def get_quantile(hist, level):
     
     return estHeight
 
-def full_day_stereo_to_height(calib_dir, in_dir, out_dir):
-    
-    # load camera intrinsic parameters
-    calib = calibration.StereoCalibration()
-    calib.load(calib_dir)
+def full_day_stereo_to_height(calib_dir, in_dir, out_dir, processes=1, strips=1, height_range=disparity.HEIGHT_RANGE):
     
+    # Height histograms of every capture directory of a day, on a pool of
+    # processes. Captures already committed to the day's cube are skipped, so
+    # an interrupted day can be run again.
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
+    cube_file = os.path.join(out_dir, height_hist_cube.CUBE_FILE)
+    done = height_hist_cube.HeightHistCube(cube_file).captures()
+    # build the fixed-point calibration cache once, before the workers load it
+    calib_cache = os.path.join(out_dir, calibration.CACHE_FILE)
+    load_calibration(calib_dir, calib_cache)
+    
+    jobs = [(os.path.join(in_dir, d), os.path.join(out_dir, d), cube_file, strips, height_range)
+            for d in sorted(os.listdir(in_dir))
+            if os.path.isdir(os.path.join(in_dir, d)) and d not in done]
+    print('%s: %d captures to process, %d already done' % (in_dir, len(jobs), len(done)))
+    
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)), init_height_worker, (calib_dir, calib_cache))
+        results = pool.imap_unordered(height_hist_job, jobs)
+    else:
+        pool = None
+        init_height_worker(calib_dir, calib_cache)
+        results = (height_hist_job(job) for job in jobs)
     
-    list_dirs = os.walk(in_dir)
-    for root, dirs, files in list_dirs:
-        for d in dirs:
-            i_path = os.path.join(in_dir, d)
-            o_path = os.path.join(out_dir, d)
-            if not os.path.isdir(i_path):
-                continue
-            
-            if not os.path.isdir(o_path):
-                os.mkdir(o_path)
-            else:
-                continue
-            
-            try:
-                generate_meta_height_hist(i_path, o_path, calib)
-            except Exception as ex:
-                fail(i_path + str(ex))
+    try:
+        for count, capture in enumerate(results, 1):
+            print('%d/%d %s' % (count, len(jobs), capture))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    
+    return
 
+# Per-process calibration; its rectification maps are memory-mapped read-only,
+# so every worker shares one copy through the page cache
+_worker = {}
+
+def init_height_worker(calib_dir, calib_cache):
+    
+    # one OpenCV thread per process, the pool provides the parallelism
+    cv2.setNumThreads(1)
+    _worker['calib'] = load_calibration(calib_dir, calib_cache)
+    
     return
 
+# Pyramid levels between the raw frames and the images given to SGBM
+RECTIFY_LEVELS = 2
+
+def load_calibration(calib_dir, cache_file):
+    
+    # Calibration from its single-file cache (fixed-point maps at RECTIFY_LEVELS,
+    # memory-mapped); the cache is rebuilt from the .npy files in calib_dir when
+    # missing, older than them or of another format version
+    calib = calibration.StereoCalibration()
+    newest = max([os.path.getmtime(f) for f in glob(os.path.join(calib_dir, '*.npy'))] + [0])
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= newest:
+        try:
+            if RECTIFY_LEVELS in calib.load_cache(cache_file):
+                return calib
+        except ValueError as ex:
+            fail('Rebuilding calibration cache: ' + str(ex))
+    
+    calib = calibration.StereoCalibration()
+    calib.load(calib_dir, mmap_mode='r')
+    calib.export_cache(cache_file, levels=(RECTIFY_LEVELS,))
+    calib = calibration.StereoCalibration()
+    calib.load_cache(cache_file)
+    
+    return calib
+
+def height_hist_job(args):
+    
+    # Pool entry point; a failed capture must not stop the rest of the day
+    i_path, o_path, cube_file, strips, height_range = args
+    if not os.path.isdir(o_path):
+        os.mkdir(o_path)
+    try:
+        generate_meta_height_hist(i_path, o_path, _worker['calib'], height_hist_cube.HeightHistCube(cube_file),
+                                  strips, height_range)
+    except Exception as ex:
+        fail(i_path + str(ex))
+    
+    return os.path.basename(i_path)
+
 def stereo_height_data_integrate_per_day(in_dir, out_dir):
     
-    list_dirs = os.walk(in_dir)
-    heightHist = np.zeros((1728, 400))
+    cube_file = os.path.join(in_dir, height_hist_cube.CUBE_FILE)
+    if os.path.exists(cube_file):
+        heightHist = height_hist_cube.HeightHistCube(cube_file).day_hist()
+        list_dirs = []
+    else:
+        # days processed before the per-day cube, with a <plot>.npy per plot per capture
+        list_dirs = os.walk(in_dir)
+        heightHist = np.zeros((1728, 400))
     
     for root, dirs, files in list_dirs:
         for d in dirs:
@@ -325,23 +407,11 @@ def stereo_image_to_disparity(calib_dir, image_dir, out_dir):
             cv2.imwrite(os.path.join(i_path, 'rectify1.png'), newFrame[1])
     
             # disparity range is tuned for 'aloe' image pair
-            window_size = 9
             min_disp = 1
             num_disp = 321-min_disp
-            stereo = cv2.StereoSGBM(minDisparity = min_disp,
-                numDisparities = num_disp,
-                SADWindowSize = window_size,
-                uniquenessRatio = 2,
-                speckleWindowSize = 50,
-                speckleRange = 3,
-                disp12MaxDiff = 3,
-                P1 = 8*window_size*window_size,
-                P2 = 32*window_size*window_size,
-                fullDP = False
-            )
         
             print 'computing disparity...'
-            disp1 = stereo.compute(imgL, imgR).astype(np.float32) / 16.0
+            disp1 = disparity.compute_disparity(imgL, imgR, min_disp, num_disp)
             #disp = cv2.pyrUp(cv2.pyrUp(disp1))
             disp = disp1#cv2.resize(disp1, (3296, 2472),0, 0, cv2.INTER_AREA)
             cv2.imwrite(os.path.join(i_path, 'disp.png'), disp)
@@ -381,7 +451,7 @@ def stereo_image_to_disparity(calib_dir, image_dir, out_dir):
     
     return
 
-def generate_meta_height_hist(in_dir, out_dir, calib):
+def generate_meta_height_hist(in_dir, out_dir, calib, cube=None, strips=1, height_range=disparity.HEIGHT_RANGE):
     
     meta, bin_left, bin_right = find_input_files(in_dir)
     if meta == [] or bin_left == [] or bin_right == []:
@@ -390,55 +460,51 @@ def generate_meta_height_hist(in_dir, out_dir, calib):
     metadata = lower_keys(load_json(meta))
     plotNum = get_plot_num(metadata)
     if plotNum == 0:
+        if cube is not None:
+            # outside the field: record the capture as done, with no plots
+            cube.commit(os.path.basename(os.path.normpath(out_dir)), [], [])
         return
     
     imgSize = [3296, 2472]
-    generate_height_hist(metadata, bin_left, bin_right, out_dir, calib, imgSize)
+    generate_height_hist(metadata, bin_left, bin_right, out_dir, calib, imgSize, cube, strips, height_range)
     
     return
 
-def generate_height_hist(metadata, bin_left, bin_right, out_dir, calib, imgSize):
+def generate_height_hist(metadata, bin_left, bin_right, out_dir, calib, imgSize, cube=None, strips=1,
+                         height_range=disparity.HEIGHT_RANGE):
     
     # create left and right image
     left_img = process_image(bin_left, imgSize)
     right_img = process_image(bin_right, imgSize)
     
-    # create disparity image
-    frames = []
-    frames.append(left_img)
-    frames.append(right_img)
-    newFrame = calib.rectify(frames)
-            
-    imgL = cv2.pyrDown(cv2.pyrDown( newFrame[0] ))
-    imgR = cv2.pyrDown(cv2.pyrDown( newFrame[1] ))
-    
-    window_size = 9
-    min_disp = 1
-    num_disp = 321-min_disp
-    stereo = cv2.StereoSGBM(minDisparity = min_disp,
-        numDisparities = num_disp,
-        SADWindowSize = window_size,
-        uniquenessRatio = 2,
-        speckleWindowSize = 50,
-        speckleRange = 3,
-        disp12MaxDiff = 3,
-        P1 = 8*window_size*window_size,
-        P2 = 32*window_size*window_size,
-        fullDP = False
-    )
+    # create disparity image; the frames are reduced and then rectified with
+    # the calibration for that resolution, rather than rectified at full resolution
+    small_calib = calib.downscaled(RECTIFY_LEVELS)
+    frames = [left_img, right_img]
+    for level in range(RECTIFY_LEVELS):
+        frames = [cv2.pyrDown(frame) for frame in frames]
+    imgL, imgR = small_calib.rectify(frames, cv2.INTER_LINEAR)
+    
+    Q = small_calib.disp_to_depth_mat
+    focuLength = Q[2][3] # already shrunk twice
+    baseLine = 217.3468 # in mm
+    center_position = get_position(metadata)
+    
+    # search only the disparities of points within height_range of the ground
+    if height_range:
+        min_disp, num_disp = disparity.disparity_window(center_position[2]*1000, focuLength, baseLine, height_range)
+    else:
+        min_disp = 1
+        num_disp = 321-min_disp
         
     print 'computing disparity...'
-    disp = stereo.compute(imgL, imgR).astype(np.float32) / 16.0
+    disp = disparity.compute_disparity(imgL, imgR, min_disp, num_disp, strips)
     # disparity threshold
-    mask = [np.logical_and(disp > 132, disp < 320)]
+    mask = [np.logical_and(disp > disparity.KEEP_DISP[0], disp < disparity.KEEP_DISP[1])]
     mask2 = green_mask(imgL, 3)
     mask3 = mask[0]&mask2
     
     # disparity_to_distance
-    Q = calib.disp_to_depth_mat
-    focuLength = Q[2][3] / 4.0 # shrink twice
-    baseLine = 217.3468 # in mm
-    center_position = get_position(metadata)
     Z = disparity_to_distance(disp, focuLength, baseLine)
     heightMap = center_position[2]*1000 - Z
     #heightMap = heightMap[mask3]
@@ -462,44 +528,48 @@ def generate_height_hist(metadata, bin_left, bin_right, out_dir, calib, imgSize)
     res = cv2.bitwise_and(show_img,show_img,mask = leaf_mask)
     cv2.imwrite(os.path.join(out_dir, 'left.jpg'), np.rot90(res))
     
-    export_height_data_to_file(heightMap, out_dir, plotNum, pixelBoundary, mask3)
+    export_height_data_to_file(heightMap, out_dir, plotNum, pixelBoundary, mask3, cube)
     
     return
 
 
-def export_height_data_to_file(heightMap, out_dir, plotNum, pixelBoundary, leaf_mask):
+def export_height_data_to_file(heightMap, out_dir, plotNum, pixelBoundary, leaf_mask, cube=None):
     
     if not os.path.isdir(out_dir):
         return
     
-    heightMap = np.rot90(heightMap)
-    leaf_mask = np.rot90(leaf_mask)
-    #z_shift = 400 - 65
-    for plot, bound in zip(plotNum, pixelBoundary):
-        roi_map = heightMap[:, bound[0]:bound[1]]
-        roi_mask = leaf_mask[:, bound[0]:bound[1]]
-        roi_map = roi_map[roi_mask]
+    hists = plot_height_hists(np.rot90(heightMap), pixelBoundary, np.rot90(leaf_mask))
+    if cube is not None:
+        # one commit per capture into the day's cube, named by the capture directory
+        cube.commit(os.path.basename(os.path.normpath(out_dir)), plotNum, hists)
+        return
     
-        zOffset = 8
-        zRange = [0, 3200]
-        hist = np.zeros(400)
-        
-        zloop = 0
-        for z in range(zRange[0],zRange[1], zOffset):       
-            zmin = z
-            zmax = (z+zOffset)
-            zIndex = np.where((roi_map>zmin) & (roi_map<zmax));
-            num = len(zIndex[0])
-            hist[zloop] = num
-            zloop = zloop + 1
-        
-        
-        #hist_shift = np.concatenate((hist[z_shift:], hist[:z_shift]))
+    for plot, hist in zip(plotNum, hists):
         out_file_name = os.path.join(out_dir, str(plot)+'.npy')
         np.save(out_file_name, hist)
     
     return
 
+# Height histogram: HIST_BINS bins of HIST_BIN_MM from 0 mm, open at both ends
+HIST_BIN_MM = 8
+HIST_BINS = height_hist_cube.HIST_BINS
+
+def plot_height_hists(heightMap, pixelBoundary, leaf_mask):
+    
+    # (plots, HIST_BINS) counts of the masked heights in each plot's columns; bin k
+    # counts zmin < h < zmax for zmin = k*HIST_BIN_MM, so heights on a bin edge are dropped
+    with np.errstate(invalid='ignore'):
+        bins = np.floor_divide(heightMap, HIST_BIN_MM)
+    valid = leaf_mask & (heightMap > 0) & (heightMap < HIST_BINS*HIST_BIN_MM) & (bins*HIST_BIN_MM != heightMap)
+    
+    index = []
+    for i, bound in enumerate(pixelBoundary):
+        roi_bins = bins[:, bound[0]:bound[1]][valid[:, bound[0]:bound[1]]]
+        index.append(roi_bins.astype(np.int64) + i*HIST_BINS)
+    
+    counts = np.bincount(np.concatenate(index + [np.zeros(0, np.int64)]), minlength=len(pixelBoundary)*HIST_BINS)
+    return counts.reshape(len(pixelBoundary), HIST_BINS).astype(np.float64)
+
 
 def get_plot_num(meta):
     
@@ -709,21 +779,10 @@ def green_mask(img, kernelSize):
     
     r = img[:,:,0]
     g = img[:,:,1]
-    b = img[:,:,2]
-    
-    sub_img = (g.astype('int') - r.astype('int') + 2) > 0 # normal: -2
     
-    mask = np.zeros_like(b)
+    sub_img = np.subtract(g, r, dtype=np.int16) > -2 # normal: -2
     
-    mask[sub_img] = 255
-    
-    im = Image.fromarray(mask)
-    blur = im.filter(ImageFilter.BLUR)
-    pix = np.array(blur)
-    #blur = cv2.blur(mask,(kernelSize,kernelSize))
-    
-    #pix = cv2.pyrDown(cv2.pyrDown( pix ))
-    sub_mask = pix > 128
+    sub_mask = box_filter.majority(sub_img, kernelSize)
     
     return sub_mask
 
@@ -843,37 +902,11 @@ def get_fov(metadata, camHeight, shape):
     return (fix_fov_x, fix_fov_y)
 
 def process_image(im_path, shape):
-    im = np.fromfile(im_path, dtype='uint8').reshape(shape[::-1])
-    im_color = demosaic(im)
+    im_color = demosaic(read_frame(im_path, shape))
     #out_path = im_path[:-4] + '.jpg'
     #Image.fromarray(im_color).save(out_path)
     return im_color
 
-def demosaic(im):
-    # Assuming GBRG ordering.
-    B = np.zeros_like(im)
-    R = np.zeros_like(im)
-    G = np.zeros_like(im)
-    R[0::2, 1::2] = im[0::2, 1::2]
-    B[1::2, 0::2] = im[1::2, 0::2]
-    G[0::2, 0::2] = im[0::2, 0::2]
-    G[1::2, 1::2] = im[1::2, 1::2]
-
-    fG = np.asarray(
-            [[0, 1, 0],
-             [1, 4, 1],
-             [0, 1, 0]]) / 4.0
-    fRB = np.asarray(
-            [[1, 2, 1],
-             [2, 4, 2],
-             [1, 2, 1]]) / 4.0
-
-    im_color = np.zeros(im.shape+(3,), dtype='uint8') #RGB
-    im_color[:, :, 0] = convolve(R, fRB)
-    im_color[:, :, 1] = convolve(G, fG)
-    im_color[:, :, 2] = convolve(B, fRB)
-    return im_color
-
 def load_json(meta_path):
     try:
         with open(meta_path, 'r') as fin:
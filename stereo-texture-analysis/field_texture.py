@@ -0,0 +1,84 @@
+'''
+Haralick texture features of every plot in a field mosaic in one pass.
+
+Rather than clipping each plot and building its co-occurrence matrices
+separately, DGCI is computed and quantised once per row block of the mosaic,
+every plot polygon is burned into a label image (plot_labels), and the
+co-occurrence counts of all plots come out of one np.bincount per block and
+scale (gift_features.glcm_counts). Counts of consecutive blocks add up, so
+the result does not depend on the block size.
+
+    names, columns, values = field_texture.haralick_by_plot(rast_path, plots)
+
+values is a (plots, features) array with the gift_features.haralick_columns.
+The scale-s subsampling takes every s-th pixel of the mosaic rather than of
+each plot's clipped image, so for s > 1 the pixels used can be offset from
+the per-plot gift.R values by up to s - 1 pixels.
+'''
+
+import numpy as np
+from osgeo import gdal
+
+import gift_features
+from plot_labels import plot_label_layer, rasterize_labels, raster_grid, cached_label_image
+
+# Rows per block read from the raster; rounded to a multiple of every scale
+BLOCK_ROWS = 1024
+
+
+def haralick_by_plot(rast_path, plots, scales=gift_features.HARALICK_SCALES, block_rows=BLOCK_ROWS, cache=None):
+    """
+    (plot names, column names, (plots, 13*len(scales)) array) of the Haralick
+    features of every plot of an RGB GeoTIFF/VRT. plots is a dict of plot
+    name -> GeoJSON geometry string; plots covering no pixel pairs get zeros.
+    Given a plot_cache.PlotCache, the label image is read from the cache.
+    """
+    rast = gdal.Open(rast_path)
+    grid = raster_grid(rast)
+    xsize, ysize = rast.RasterXSize, rast.RasterYSize
+    names = sorted(plots.keys())
+    nlabels = len(names)
+    nbins = gift_features.HARALICK_NBINS
+
+    labels_path = cached_label_image(cache, plots, names, grid)
+    if labels_path:
+        label_image = np.load(labels_path, mmap_mode='r')
+    else:
+        source, layer = plot_label_layer(plots, names, rast.GetProjection())
+
+    step = _lcm(scales)
+    block_rows = max(step, block_rows//step*step)
+    halo = max(scales)
+    counts = dict((s, np.zeros((nlabels, nbins, nbins), dtype=np.int64)) for s in scales)
+
+    for top in range(0, ysize, block_rows):
+        bottom = min(top + block_rows, ysize)
+        # block rows plus, above them, the last subsampled row of the previous block at every scale
+        read_top = max(top - halo, 0)
+        pixels = rast.ReadAsArray(0, read_top, xsize, bottom - read_top)
+        levels = gift_features.quantise(gift_features.dgci(np.rollaxis(pixels[:3], 0, 3)), nbins)
+        del pixels
+        if labels_path:
+            labels = np.asarray(label_image[read_top:bottom])
+        else:
+            labels = rasterize_labels(layer, grid[0], grid[1], xsize, read_top, bottom - read_top)
+
+        for s in scales:
+            # top is a multiple of s, so rows top, top+s, ... continue the previous block's
+            start = top - s - read_top if top > 0 else 0
+            counts[s] += gift_features.glcm_counts(labels[start::s, ::s], levels[start::s, ::s],
+                                                   nlabels, nbins, halo=top > 0)
+
+    rast = None
+    values = np.hstack([gift_features.haralick_features(gift_features.normalise_glcm(counts[s])) for s in scales])
+    return names, gift_features.haralick_columns(scales), values
+
+
+def _lcm(values):
+    result = 1
+    for v in values:
+        a, b = result, int(v)
+        while b:
+            a, b = b, a % b
+        result = result*int(v)//a
+    return result
@@ -0,0 +1,184 @@
+'''
+Batched submission of geostreams datapoints.
+
+terrautils.geostreams.create_datapoint_with_dependencies looks up the BETY
+sites at a point, then finds or creates the sensor and stream of each site
+and posts one datapoint, every request sequential and on a new connection.
+DatapointBatch does the same work in bulk:
+
+    batch = geostreams_batch.DatapointBatch(connector, host, key, "Canopy Cover",
+                                            workers=self.args.geostreams_workers)
+    for plot ...:
+        batch.add((lat, lon), time_fmt, time_fmt, dpmetadata, timestamp)
+    batch.flush()
+
+Datapoints are buffered until flush (or until batch_size are waiting); the
+site lookups, sensor/stream lookups and posts then run on a thread pool over
+one keep-alive session. Sensor and stream ids are cached for the life of the
+process, so later messages skip those lookups, and streams with several
+buffered datapoints get them in a single request to the bulk endpoint.
+
+The module is copied into each extractor directory that uses it; keep the
+copies identical.
+'''
+
+import os, json, logging, threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from terrautils.betydb import get_sites_by_latlon
+from terrautils.gdal import wkt_to_geojson
+
+# Sensor properties of the plot sensors, as created by terrautils.geostreams
+SENSOR_TYPE = {"id": "MAC Field Scanner", "title": "MAC Field Scanner", "sensorType": 4}
+SENSOR_REGION = "Maricopa"
+
+
+def add_arguments(parser):
+    parser.add_argument('--geostreams-workers', type=int, default=os.getenv('GEOSTREAMS_WORKERS', 8),
+                        help="concurrent requests used to submit geostreams datapoints")
+    parser.add_argument('--geostreams-batch', type=int, default=os.getenv('GEOSTREAMS_BATCH', 1000),
+                        help="buffered geostreams datapoints that trigger a submission")
+
+
+# (host, 'sensor'|'stream', name) -> id, shared by every batch in the process
+_ids = {}
+_ids_lock = threading.Lock()
+
+
+class DatapointBatch(object):
+    """
+    Buffer of datapoints for one host and stream prefix.
+
+    site_lookup(latlon, filter_date) returns the BETY sites containing a
+    point; it defaults to terrautils.betydb.get_sites_by_latlon.
+    """
+
+    def __init__(self, connector, host, key, streamprefix, workers=8, batch_size=1000, site_lookup=None):
+        self.connector = connector
+        self.host = host
+        self.key = key
+        self.streamprefix = streamprefix
+        self.workers = max(1, int(workers))
+        self.batch_size = int(batch_size)
+        self.site_lookup = site_lookup or get_sites_by_latlon
+        self.created = 0
+
+        self._pending = []
+        self._session = requests.Session()
+        self._session.verify = connector.ssl_verify if connector else True
+        self._session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+
+    def add(self, latlon, starttime, endtime, metadata={}, filter_date='', geom=None):
+        """Queue a datapoint at every site containing latlon; arguments as for create_datapoint_with_dependencies."""
+        self._pending.append((latlon, starttime, endtime, metadata, filter_date, geom))
+        if self.batch_size > 0 and len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Submit the buffered datapoints; returns the number of datapoints created."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+
+        pool = ThreadPool(self.workers)
+        try:
+            site_lists = pool.map(self._sites, [(p[0], p[4]) for p in pending])
+
+            # One sensor and stream per distinct site
+            site_geoms = {}
+            for sites in site_lists:
+                site_geoms.update(sites)
+            names = sorted(site_geoms)
+            sensor_ids = pool.map(self._sensor_id, [(name, site_geoms[name]) for name in names])
+            stream_ids = pool.map(self._stream_id, [(sensor_id, site_geoms[name])
+                                                    for name, sensor_id in zip(names, sensor_ids)])
+            stream_of = dict(zip(names, stream_ids))
+
+            by_stream = {}
+            for (latlon, starttime, endtime, metadata, filter_date, geom), sites in zip(pending, site_lists):
+                for name, site_geom in sites:
+                    by_stream.setdefault(stream_of[name], []).append({
+                        "start_time": starttime,
+                        "end_time": endtime,
+                        "type": "Point",
+                        "geometry": geom or site_geom,
+                        "properties": metadata
+                    })
+            counts = pool.map(self._post_datapoints, list(by_stream.items()))
+        finally:
+            pool.close()
+            pool.join()
+
+        logging.info("created %s geostreams datapoints in %s streams" % (sum(counts), len(by_stream)))
+        self.created += sum(counts)
+        return sum(counts)
+
+    def _sites(self, job):
+        # [(site name, GeoJSON geometry)] of the sites containing a point
+        latlon, filter_date = job
+        sites = []
+        for s in self.site_lookup(latlon, filter_date):
+            if s['sitename'] not in [name for name, _ in sites]:
+                sites.append((s['sitename'], json.loads(wkt_to_geojson(s['geometry']))))
+        return sites
+
+    def _sensor_id(self, job):
+        name, geom = job
+        return self._cached_id('sensor', name, lambda: self._create('sensors', {
+            "name": name,
+            "type": "Point",
+            "geometry": geom,
+            "properties": {
+                "popupContent": name,
+                "type": SENSOR_TYPE,
+                "name": name,
+                "region": SENSOR_REGION
+            }
+        }))
+
+    def _stream_id(self, job):
+        sensor_id, geom = job
+        name = "%s (%s)" % (self.streamprefix, sensor_id)
+        return self._cached_id('stream', name, lambda: self._create('streams', {
+            "name": name,
+            "type": "Feature",
+            "geometry": geom,
+            "properties": {},
+            "sensor_id": str(sensor_id)
+        }))
+
+    def _cached_id(self, kind, name, create):
+        # Id of the named sensor/stream: from the cache, the server, or a new one
+        key = (self.host, kind, name)
+        with _ids_lock:
+            if key in _ids:
+                return _ids[key]
+
+        result = self._session.get("%sapi/geostreams/%ss" % (self.host, kind),
+                                   params={kind + "_name": name, "key": self.key})
+        result.raise_for_status()
+        found = [entry['id'] for entry in result.json() if entry.get('name') == name]
+        ident = found[0] if found else create()
+
+        with _ids_lock:
+            _ids[key] = ident
+        return ident
+
+    def _create(self, endpoint, body):
+        result = self._session.post("%sapi/geostreams/%s" % (self.host, endpoint), params={"key": self.key},
+                                    headers={'Content-type': 'application/json'}, data=json.dumps(body))
+        result.raise_for_status()
+        return result.json()['id']
+
+    def _post_datapoints(self, job):
+        stream_id, datapoints = job
+        if len(datapoints) == 1:
+            self._create('datapoints', dict(datapoints[0], stream_id=str(stream_id)))
+        else:
+            result = self._session.post("%sapi/geostreams/datapoints/bulk" % self.host, params={"key": self.key},
+                                        headers={'Content-type': 'application/json'},
+                                        data=json.dumps({"datapoints": datapoints, "stream_id": str(stream_id)}))
+            result.raise_for_status()
+        return len(datapoints)
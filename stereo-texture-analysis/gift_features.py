@@ -0,0 +1,255 @@
+'''
+numpy port of the gift.R feature table, for computing plot texture features
+in process instead of running Rscript on a PNG per plot.
+
+    columns, rows = gift_features.feature_table(rgb, roi)
+    gift_features.write_table(out_csv, columns, rows)
+
+The steps follow gift.R and the EBImage functions it calls:
+
+1. DGCI from rgb2hsv of the 0-1 image. gift.R keeps rgb2hsv's default
+   maxColorValue of 255, so V ends up in [0, 1/255], and by R precedence
+   (h - 1/6) / 1/6 is (h - 1/6) / 6. Both are reproduced, so the values
+   match the R table.
+2. Sobel gradient magnitude of the DGCI image (filter2, circular boundary).
+3. Edges: thresh(g, 3, 3, 0.1), i.e. g > 7x7 mean of g + 0.1.
+4. Per connected ROI region (bwlabel, 8-connected): pixel count, edge count
+   and a histogram of DGCI in 0.1-wide right-closed bins from -0.1 to 3.
+5. Mean DGCI and the 13 Haralick features of each region
+   (computeFeatures.haralick: DGCI clipped to [0, 1] and quantised to 32
+   grey levels, symmetric co-occurrences of pixel pairs of the same region
+   at distance 1 in the four directions, every scale-th pixel per scale).
+
+With an ROI, the mean DGCI is taken over the ROI pixels only, where gift.R
+averages the whole image; without one the two agree. Pixels outside the ROI
+still go through the Sobel and threshold windows of the pixels next to it,
+so clipped plots should have them filled from the ROI (fill_outside) rather
+than left as a constant fill value, which would add a false edge all along
+the plot border.
+'''
+
+import numpy as np
+
+# hist(dgci, breaks = seq(-0.1, 3, 0.1)): R computes seq as from + (0:n)*by
+HIST_BREAKS = -0.1 + np.arange(32)*0.1
+HARALICK_NBINS = 32
+# computeFeatures.haralick defaults; gift.R's "scales = 1" is not an argument of
+# that function and goes into its "...", so both default scales are computed
+HARALICK_SCALES = (1, 2)
+HARALICK_NAMES = ('asm', 'con', 'cor', 'var', 'idm', 'sav', 'sva', 'sen', 'ent', 'dva', 'den', 'f12', 'f13')
+
+
+def feature_table(rgb, roi=None, scales=HARALICK_SCALES):
+    """
+    The gift.R --table output for an (rows, cols, 3+) uint8 RGB image, as
+    (column names, rows); one row per connected region of the boolean roi
+    mask (the whole image if roi is None).
+    """
+    d = dgci(rgb)
+    edge = edges(d)
+    if roi is None:
+        labels = np.ones(d.shape, dtype=np.int32)
+    else:
+        labels = label_regions(roi)
+    nlabels = int(labels.max())
+
+    inside = labels > 0
+    area = np.bincount(labels[inside], minlength=nlabels+1)[1:]
+    edge_count = np.bincount(labels[inside], weights=edge[inside], minlength=nlabels+1)[1:]
+    hist = label_histograms(labels[inside], d[inside], nlabels)
+    haralick = [haralick_features(glcm(labels, d, scale=s, nlabels=nlabels)) for s in scales]
+    mean = float(d[inside].mean()) if nlabels else 0.0
+
+    columns = ['roi', 'area', 'edges'] + histogram_columns() + ['dgci'] + haralick_columns(scales)
+    rows = []
+    for i in range(nlabels):
+        rows.append([i+1, int(area[i]), int(edge_count[i])] + [int(c) for c in hist[i]] +
+                    [mean] + [float(v) for h in haralick for v in h[i]])
+    return columns, rows
+
+
+def fill_outside(rgb, roi):
+    """Copy of an image with every pixel outside the boolean roi set to the nearest pixel inside it."""
+    if roi.all() or not roi.any():
+        return rgb
+    from scipy import ndimage
+    index = ndimage.distance_transform_edt(~roi, return_distances=False, return_indices=True)
+    return rgb[tuple(index)]
+
+
+def dgci(rgb):
+    """Dark green colour index of an RGB image, as computed in gift.R."""
+    # readImage scales to 0-1 and rgb2hsv divides by maxColorValue = 255 again
+    px = rgb[..., :3].astype(np.float64)/255.0/255.0
+    r, g, b = px[..., 0], px[..., 1], px[..., 2]
+    mx = np.maximum(np.maximum(r, g), b)
+    delta = mx - np.minimum(np.minimum(r, g), b)
+    gray = delta == 0
+    safe_delta = np.where(gray, 1, delta)
+
+    # rgb2hsv's tie-breaking: red if r > g and r >= b, else blue if b is the larger, else green
+    r_max = (r > g) & (b <= r)
+    b_max = ~r_max & (b > np.maximum(r, g))
+    h = np.where(r_max, (g - b)/safe_delta,
+                 np.where(b_max, 4 + (r - g)/safe_delta, 2 + (b - r)/safe_delta))/6
+    h = np.where(h < 0, h + 1, h)
+    h[gray] = 0
+    s = np.where(gray, 0, delta/np.where(mx == 0, 1, mx))
+
+    return (((h - 1/6.0)/1/6.0) + (1 - s) + (1 - mx))/3
+
+
+def edges(d, w=3, h=3, offset=0.1):
+    """thresh(sobel magnitude of d, w, h, offset) as 0/1, with EBImage's circular boundaries."""
+    p = np.pad(d, 1, mode='wrap')
+    # separable Sobel: smooth [1, 2, 1] across, difference [1, 0, -1] along each axis
+    gx = (p[2:, :-2] + 2*p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2*p[:-2, 1:-1] + p[:-2, 2:])
+    gy = (p[:-2, 2:] + 2*p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2*p[1:-1, :-2] + p[2:, :-2])
+    mag = np.sqrt(gx*gx + gy*gy)
+
+    window = (2*h+1)*(2*w+1)
+    p = np.pad(mag, ((h, h), (w, w)), mode='wrap')
+    rows = sum(p[i:i+mag.shape[0]] for i in range(2*h+1))
+    total = sum(rows[:, j:j+mag.shape[1]] for j in range(2*w+1))
+    return (mag > total/window + offset).astype(np.uint8)
+
+
+def label_regions(roi):
+    """bwlabel: 8-connected regions of a boolean mask, numbered from 1 in raster order."""
+    from scipy import ndimage
+    labels, _ = ndimage.label(roi, structure=np.ones((3, 3)))
+    return labels
+
+
+def histogram_columns():
+    # paste0("dgci.", breaks) for all but the last break, as R prints them
+    return ['dgci.%s' % ('%.15g' % b) for b in HIST_BREAKS[:-1]]
+
+
+def label_histograms(labels, values, nlabels):
+    """(nlabels, 31) counts of values per label in R's hist bins (right-closed, first bin closed)."""
+    # hist() widens the breaks by 1e-7 of the bin width so values on a break land consistently
+    fuzz = 1e-7*0.1
+    breaks = HIST_BREAKS + fuzz
+    breaks[0] -= 2*fuzz
+    nbins = len(HIST_BREAKS) - 1
+    bins = np.searchsorted(breaks, values, side='left') - 1
+    if len(values) and (bins.min() < 0 or bins.max() >= nbins):
+        raise ValueError("DGCI values outside the histogram breaks")
+    counts = np.bincount((labels.astype(np.int64) - 1)*nbins + bins, minlength=nlabels*nbins)
+    return counts.reshape(nlabels, nbins)
+
+
+def quantise(d, nbins=HARALICK_NBINS):
+    """computeFeatures.haralick grey levels: d clipped to [0, 1], floor(d * (nbins - 1))."""
+    return np.floor(np.clip(d, 0, 1)*(nbins - 1)).astype(np.intp)
+
+
+def glcm(labels, d, nbins=HARALICK_NBINS, scale=1, nlabels=None):
+    """
+    (nlabels, nbins, nbins) normalised grey level co-occurrence matrices of
+    each label: symmetric counts of same-label pixel pairs at distance 1 in the
+    0, 45, 90 and 135 degree directions, on every scale-th pixel.
+    """
+    if nlabels is None:
+        nlabels = int(labels.max())
+    counts = glcm_counts(labels[::scale, ::scale], quantise(d[::scale, ::scale], nbins), nlabels, nbins)
+    return normalise_glcm(counts)
+
+
+def glcm_counts(labels, levels, nlabels, nbins=HARALICK_NBINS, halo=False):
+    """
+    (nlabels, nbins, nbins) integer co-occurrence counts of every label at
+    once, from one np.bincount over the combined (label, level, level) index
+    of all pixel pairs.
+
+    With halo, the first row is the last row of the previous block: it is
+    only paired with the row below, so counts of consecutive row blocks add
+    up to the counts of the whole image.
+    """
+    rows, cols = labels.shape
+    indices = []
+    for dy, dx in ((0, 1), (1, 1), (1, 0), (1, -1)):
+        # (a, b) = pixel and its neighbour at (+dy, +dx)
+        y0 = 1 if halo and dy == 0 else 0
+        x0, x1 = max(0, -dx), cols - max(0, dx)
+        la, lb = labels[y0:rows-dy, x0:x1], labels[y0+dy:, x0+dx:x1+dx]
+        same = (la == lb) & (la > 0)
+        base = (la[same].astype(np.int64) - 1)*nbins*nbins
+        ga, gb = levels[y0:rows-dy, x0:x1][same], levels[y0+dy:, x0+dx:x1+dx][same]
+        indices += [base + ga*nbins + gb, base + gb*nbins + ga]
+    counts = np.bincount(np.concatenate(indices), minlength=nlabels*nbins*nbins)
+    return counts.reshape(nlabels, nbins, nbins)
+
+
+def normalise_glcm(counts):
+    counts = counts.astype(np.float64)
+    totals = counts.sum(axis=(1, 2))
+    return counts/np.where(totals > 0, totals, 1)[:, None, None]
+
+
+def haralick_columns(scales=HARALICK_SCALES):
+    return ['h.%s.s%d' % (name, s) for s in scales for name in HARALICK_NAMES]
+
+
+def haralick_features(p):
+    """
+    The 13 Haralick features (HARALICK_NAMES) of each normalised (n, nbins,
+    nbins) co-occurrence matrix, as an (n, 13) array; grey levels count from 0
+    and entropies use the natural log.
+    """
+    n, nbins = p.shape[0], p.shape[1]
+    i, j = np.indices((nbins, nbins))
+    k = np.arange(2*nbins - 1)
+
+    px, py = p.sum(axis=2), p.sum(axis=1)
+    levels = np.arange(nbins)
+    mux, muy = (px*levels).sum(axis=1), (py*levels).sum(axis=1)
+    sdx = np.sqrt((px*(levels - mux[:, None])**2).sum(axis=1))
+    sdy = np.sqrt((py*(levels - muy[:, None])**2).sum(axis=1))
+
+    # p_{x+y}(k) and p_{x-y}(k)
+    psum = np.stack([p[:, i + j == s].sum(axis=1) for s in k], axis=1)
+    pdiff = np.stack([p[:, np.abs(i - j) == s].sum(axis=1) for s in levels], axis=1)
+
+    f = np.zeros((n, len(HARALICK_NAMES)))
+    f[:, 0] = (p*p).sum(axis=(1, 2))
+    f[:, 1] = (p*(i - j)**2).sum(axis=(1, 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f[:, 2] = np.where(sdx*sdy > 0, ((p*i*j).sum(axis=(1, 2)) - mux*muy)/(sdx*sdy), 0)
+    f[:, 3] = (p*(i[None] - mux[:, None, None])**2).sum(axis=(1, 2))
+    f[:, 4] = (p/(1 + (i - j)**2)).sum(axis=(1, 2))
+    f[:, 5] = (psum*k).sum(axis=1)
+    f[:, 7] = -_xlogx(psum).sum(axis=1)
+    f[:, 6] = (psum*(k - f[:, 5][:, None])**2).sum(axis=1)
+    f[:, 8] = -_xlogx(p).sum(axis=(1, 2))
+    mudiff = (pdiff*levels).sum(axis=1)
+    f[:, 9] = (pdiff*(levels - mudiff[:, None])**2).sum(axis=1)
+    f[:, 10] = -_xlogx(pdiff).sum(axis=1)
+
+    hx, hy = -_xlogx(px).sum(axis=1), -_xlogx(py).sum(axis=1)
+    pxpy = px[:, :, None]*py[:, None, :]
+    hxy1 = -(p*_log(pxpy)).sum(axis=(1, 2))
+    hxy2 = -_xlogx(pxpy).sum(axis=(1, 2))
+    hmax = np.maximum(hx, hy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f[:, 11] = np.where(hmax > 0, (f[:, 8] - hxy1)/hmax, 0)
+    f[:, 12] = np.sqrt(np.clip(1 - np.exp(-2*(hxy2 - f[:, 8])), 0, None))
+    return f
+
+
+def write_table(path, columns, rows):
+    """write.table(sep = ";", row.names = FALSE, quote = FALSE), as gift.R writes it."""
+    with open(path, 'w') as f:
+        f.write(';'.join(columns) + '\n')
+        for row in rows:
+            f.write(';'.join('%.15g' % v if isinstance(v, float) else str(v) for v in row) + '\n')
+
+
+def _log(x):
+    # log with log(0) = 0, so 0 * log(0) terms vanish
+    return np.log(np.where(x > 0, x, 1))
+
+
+def _xlogx(x):
+    return x*_log(x)
@@ -0,0 +1,96 @@
+'''
+Client of gift_worker.R, one long-lived R process computing the gift.R
+feature table for batches of plot images sent over a pipe.
+
+    worker = GiftWorker()
+    tables = worker.tables([(rgb, roi), ...])    # [(columns, rows) or None]
+    worker.close()
+
+The R process is started on first use and restarted if it has exited. It
+keeps gift.R as the reference implementation while avoiding an Rscript
+start-up, a PNG write and a CSV read per plot.
+'''
+
+import os, subprocess, threading
+import numpy as np
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gift_worker.R')
+
+
+class GiftWorker(object):
+    """A gift_worker.R process; batches from several threads are sent one at a time."""
+
+    def __init__(self, script=WORKER_SCRIPT, rscript='Rscript'):
+        self.command = [rscript, script]
+        self.proc = None
+        self._lock = threading.Lock()
+
+    def tables(self, plots):
+        """
+        gift.R tables of a batch of (rgb, roi) plots, where rgb is an (rows,
+        cols, 3) uint8 array and roi a boolean mask or None for the whole
+        image. Returns (column names, rows) per plot, or None for a plot the
+        worker could not process.
+        """
+        with self._lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            try:
+                self._send(plots)
+                return self._receive(len(plots))
+            except:
+                # the worker may be mid-batch; do not wait for it
+                self._stop(kill=True)
+                raise
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def _send(self, plots):
+        stdin = self.proc.stdin
+        stdin.write(('%d\n' % len(plots)).encode('ascii'))
+        for rgb, roi in plots:
+            rows, cols = rgb.shape[:2]
+            stdin.write(('%d %d %d\n' % (cols, rows, roi is not None)).encode('ascii'))
+            stdin.write(np.ascontiguousarray(rgb[:, :, :3], dtype=np.uint8).tobytes())
+            if roi is not None:
+                stdin.write(np.ascontiguousarray(roi, dtype=np.uint8).tobytes())
+        stdin.flush()
+
+    def _receive(self, count):
+        # One ';'-separated table for the batch with a leading plot index column, then END
+        tables = [None]*count
+        columns = None
+        while True:
+            line = self.proc.stdout.readline().decode('utf-8')
+            if not line:
+                raise IOError("gift_worker.R exited with status %s" % self.proc.poll())
+            line = line.rstrip('\n')
+            if line == 'END':
+                return tables
+            values = line.split(';')
+            if columns is None:
+                columns = values[1:]
+                continue
+            plot = int(values[0])
+            if tables[plot] is None:
+                tables[plot] = (columns, [])
+            tables[plot][1].append([_number(v) for v in values[1:]])
+
+    def _stop(self, kill=False):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                if kill:
+                    self.proc.kill()
+                else:
+                    self.proc.stdin.close()
+                self.proc.wait()
+            self.proc = None
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
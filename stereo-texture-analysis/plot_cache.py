@@ -0,0 +1,207 @@
+'''
+On-disk cache of the plot boundaries from terrautils.betydb.get_site_boundaries
+and of arrays derived from them, such as rasterized plot labels.
+
+The boundaries of a date only change when an experiment (season) starts or
+ends, so each entry covers the whole date range over which the same
+experiments are active. Every message in that range is then served from
+disk without contacting BETY:
+
+    cache = plot_cache.PlotCache(self.args.plot_cache, self.args.plot_cache_ttl)
+    all_plots = cache.site_boundaries(timestamp, city='Maricopa')
+
+Entries older than the TTL are fetched again; if BETY cannot be reached, a
+stale entry is used rather than failing the message. An empty cache
+directory disables the cache.
+
+Derived arrays are only kept when given a size cap in MB; past it the least
+recently used ones are deleted, as are expired ones. Label images are keyed
+by the raster grid, which differs between mosaics unless they are all
+produced on one fixed grid, so that is the only case the cap is worth
+setting for.
+
+The module is copied into each extractor directory that uses it; keep the
+copies identical.
+'''
+
+import os, json, time, glob, hashlib, logging, tempfile
+from datetime import datetime, timedelta
+
+from terrautils.betydb import get_site_boundaries, get_experiments
+
+DATE_FMT = '%Y-%m-%d'
+
+
+def add_arguments(parser):
+    parser.add_argument('--plot-cache', default=os.getenv('PLOT_CACHE_DIR', os.path.join(tempfile.gettempdir(),
+                                                                                          'plot_cache')),
+                        help="directory caching plot boundaries and plot label images; empty to disable")
+    parser.add_argument('--plot-cache-ttl', type=float, default=os.getenv('PLOT_CACHE_TTL', 24),
+                        help="hours before cached plot boundaries are fetched again from BETY; 0 never expires")
+    parser.add_argument('--plot-cache-arrays', type=float, default=os.getenv('PLOT_CACHE_ARRAYS_MB', 0),
+                        help="MB of plot label images to keep in the plot cache, least recently used evicted "
+                             "first; 0 does not cache them")
+
+
+class PlotCache(object):
+
+    def __init__(self, cache_dir, ttl_hours=24, arrays_mb=0):
+        self.cache_dir = cache_dir
+        self.ttl = float(ttl_hours)*3600
+        self.arrays_bytes = float(arrays_mb)*1024**2
+
+    def site_boundaries(self, filter_date, **kwargs):
+        """get_site_boundaries(filter_date, **kwargs), from the cache when a fresh entry covers filter_date."""
+        if not self.cache_dir:
+            return get_site_boundaries(filter_date, **kwargs)
+
+        entry = self._find_entry(filter_date, kwargs)
+        if entry and not self._expired(entry['fetched']):
+            return _geometry_strings(entry['plots'])
+
+        try:
+            plots = get_site_boundaries(filter_date, **kwargs)
+        except Exception:
+            if not entry:
+                raise
+            logging.warning("could not refresh plot boundaries for %s; using cached copy from %s" % (
+                filter_date, datetime.utcfromtimestamp(entry['fetched']).isoformat()))
+            return _geometry_strings(entry['plots'])
+
+        try:
+            start, end = season_range(get_experiments(limit='none', **kwargs) or [], filter_date)
+        except Exception as ex:
+            logging.warning("could not get the season of %s, plot boundaries not cached: %s" % (filter_date, ex))
+            return plots
+
+        self._write_json(os.path.join(self._boundaries_dir(kwargs), '%s_%s.json' % (start, end)), {
+            "query": kwargs, "start": start, "end": end, "fetched": time.time(), "plots": plots
+        })
+        logging.info("cached %s plot boundaries for %s to %s" % (len(plots), start, end))
+        return plots
+
+    def array_path(self, key, build):
+        """
+        Path of a cached .npy array identified by key (any JSON-serialisable
+        value). If missing or expired, build(path) is called to write it to a
+        temporary path that is then moved into place, so a reader never sees a
+        partial file, and the arrays are trimmed to the size cap. Returns None
+        if the cache or array caching is disabled.
+        """
+        if not self.cache_dir or self.arrays_bytes <= 0:
+            return None
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, 'arrays', digest + '.npy')
+        try:
+            if not self._expired(os.path.getmtime(path)):
+                # mtime is the last use, for the least recently used eviction
+                os.utime(path, None)
+                return path
+        except OSError:
+            pass
+
+        _makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.npy', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            build(tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self._evict_arrays(keep=path)
+        return path
+
+    def _evict_arrays(self, keep):
+        # Delete expired arrays, then the least recently used ones until the rest fit the cap
+        arrays = []
+        for path in glob.glob(os.path.join(self.cache_dir, 'arrays', '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            arrays.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in arrays)
+        for mtime, size, path in sorted(arrays):
+            if path == keep or (total <= self.arrays_bytes and not self._expired(mtime)):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def _find_entry(self, filter_date, query):
+        # Newest entry whose date range covers filter_date
+        newest = None
+        for path in glob.glob(os.path.join(self._boundaries_dir(query), '*.json')):
+            start, end = os.path.basename(path)[:-5].split('_')
+            if start <= filter_date[:10] <= end:
+                try:
+                    with open(path, 'r') as f:
+                        entry = json.load(f)
+                except ValueError:
+                    continue
+                if not newest or entry['fetched'] > newest['fetched']:
+                    newest = entry
+        return newest
+
+    def _boundaries_dir(self, query):
+        # One directory per get_site_boundaries query (e.g. city=Maricopa)
+        digest = hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, 'boundaries', digest)
+
+    def _expired(self, fetched):
+        return self.ttl > 0 and time.time() - fetched > self.ttl
+
+    def _write_json(self, path, content):
+        _makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.json', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        os.rename(tmp_path, path)
+
+
+def season_range(experiments, filter_date):
+    """
+    (start, end) dates, as YYYY-MM-DD, of the longest range around
+    filter_date in which the same experiments are active, and so
+    get_site_boundaries returns the same plots. Experiments without valid
+    start and end dates are skipped.
+    """
+    day = datetime.strptime(filter_date[:10], DATE_FMT)
+    lo, hi = datetime.min, datetime.max
+    for exp in experiments:
+        try:
+            start = datetime.strptime(exp['start_date'][:10], DATE_FMT)
+            end = datetime.strptime(exp['end_date'][:10], DATE_FMT)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if start <= day <= end:
+            lo, hi = max(lo, start), min(hi, end)
+        elif end < day:
+            lo = max(lo, end + timedelta(days=1))
+        else:
+            hi = min(hi, start - timedelta(days=1))
+    # not strftime, which rejects years before 1900 on Python 2
+    return tuple('%04d-%02d-%02d' % (d.year, d.month, d.day) for d in (lo, hi))
+
+
+def plots_digest(plots):
+    """Hash of a {plot name: geometry} dict, for keying arrays derived from it."""
+    return hashlib.sha1(json.dumps(plots, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _geometry_strings(plots):
+    # json gives unicode on Python 2; keep the geometries byte strings, as from get_site_boundaries
+    if str is bytes:
+        return dict((name, geom.encode('utf-8')) for name, geom in plots.items())
+    return plots
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
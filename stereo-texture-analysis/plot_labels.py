@@ -0,0 +1,83 @@
+'''
+Plot polygons burned into integer label images: label i is the i-th of the
+sorted plot names (from 1), 0 is outside every plot. Used by the per-plot
+zonal statistics and texture features over whole field mosaics.
+
+With a plot_cache.PlotCache, the label image of a raster grid is kept on
+disk keyed by the plots and the grid, and later mosaics on the same grid
+memory-map it instead of rasterizing again.
+
+The module is copied into each extractor directory that uses it; keep the
+copies identical.
+'''
+
+import json
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+import plot_cache
+
+# Rows rasterized at a time
+BLOCK_ROWS = 1024
+
+
+def raster_grid(rast):
+    """(geotransform, projection, xsize, ysize) of an open GDAL dataset."""
+    return (list(rast.GetGeoTransform()), rast.GetProjection(), rast.RasterXSize, rast.RasterYSize)
+
+
+def cached_label_image(cache, plots, names, grid):
+    """Path of the cached .npy label image of the plots on a raster grid, rasterized on a miss; None without a cache."""
+    if not cache:
+        return None
+    return cache.array_path(['plot_labels', plot_cache.plots_digest(plots)] + list(grid),
+                            lambda path: write_label_image(path, plots, names, *grid))
+
+
+def plot_label_layer(plots, names, projection=None):
+    # In-memory OGR layer of the plot polygons with a 1-based integer label per plot;
+    # the polygons are taken to be in the raster's coordinate system (WGS84 for the mosaics)
+    srs = osr.SpatialReference()
+    if projection:
+        srs.ImportFromWkt(projection)
+    else:
+        srs.ImportFromEPSG(4326)
+
+    source = ogr.GetDriverByName('Memory').CreateDataSource('plots')
+    layer = source.CreateLayer('plots', srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    for label, name in enumerate(names, 1):
+        geometry = plots[name]
+        if not isinstance(geometry, basestring):
+            geometry = json.dumps(geometry)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('label', label)
+        feature.SetGeometry(ogr.CreateGeometryFromJson(str(geometry)))
+        layer.CreateFeature(feature)
+        feature = None
+    return source, layer
+
+
+def write_label_image(path, plots, names, gt, projection, xsize, ysize, block_rows=BLOCK_ROWS):
+    """Rasterize the plot labels of a whole raster grid into a (ysize, xsize) .npy file, block by block."""
+    dtype = np.uint16 if len(names) < 2**16 else np.uint32
+    labels = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(ysize, xsize))
+    source, layer = plot_label_layer(plots, names, projection)
+    for top in range(0, ysize, block_rows):
+        nrows = min(block_rows, ysize - top)
+        labels[top:top+nrows] = rasterize_labels(layer, gt, projection, xsize, top, nrows)
+    labels.flush()
+    del labels
+    source = None
+
+
+def rasterize_labels(layer, gt, projection, xsize, row_offset, nrows):
+    """Burn the plot labels into an (nrows, xsize) array for the raster rows starting at row_offset."""
+    target = gdal.GetDriverByName('MEM').Create('', xsize, nrows, 1, gdal.GDT_UInt32)
+    target.SetGeoTransform((gt[0], gt[1], gt[2], gt[3] + row_offset*gt[5], gt[4], gt[5]))
+    if projection:
+        target.SetProjection(projection)
+    gdal.RasterizeLayer(target, [1], layer, options=['ATTRIBUTE=label'])
+    labels = target.GetRasterBand(1).ReadAsArray()
+    target = None
+    return labels
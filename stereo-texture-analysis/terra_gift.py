@@ -9,9 +9,12 @@ It will create csv file which contains the feature vectors.
 import os
 import logging
 import subprocess
+import shutil
+import tempfile
 import numpy
 import json
 from PIL import Image
+from multiprocessing.pool import ThreadPool
 
 from pyclowder.utils import CheckMessage
 from pyclowder.datasets import get_info, upload_metadata, download_metadata
@@ -20,16 +23,42 @@ from terrautils.extractors import TerrarefExtractor, build_dataset_hierarchy, bu
 from terrautils.sensors import Sensors
 from terrautils.formats import create_geotiff, create_image
 from terrautils.metadata import get_terraref_metadata
-from terrautils.betydb import add_arguments, get_site_boundaries, get_sites, get_sites_by_latlon, \
-    submit_traits
+from terrautils.betydb import add_arguments, get_sites, get_sites_by_latlon, submit_traits
 from terrautils.gdal import clip_raster, centroid_from_geojson
-from terrautils.geostreams import create_datapoint_with_dependencies
 from terrautils.spatial import geojson_to_tuples
 
+import stage_timer
+import geostreams_batch
+import plot_cache
+import gift_features
+import gift_worker
+
+# clip_raster fill value outside the plot polygon
+CLIP_NODATA = -9999
+
 
 def add_local_arguments(parser):
     # add any additional arguments to parser
     add_arguments(parser)
+    stage_timer.add_arguments(parser)
+    geostreams_batch.add_arguments(parser)
+    plot_cache.add_arguments(parser)
+    parser.add_argument('--plot-workers', type=int, default=os.getenv('PLOT_WORKERS', 1),
+                        help="threads clipping plots and running the texture analysis concurrently")
+    parser.add_argument('--texture-engine', default=os.getenv('TEXTURE_ENGINE', 'rscript'),
+                        choices=['numpy', 'r-worker', 'rscript'],
+                        help="compute the gift.R feature table in process (numpy), in one persistent R process "
+                             "(r-worker) or with Rscript gift.R per plot")
+    parser.add_argument('--r-batch', type=int, default=os.getenv('GIFT_R_BATCH', 32),
+                        help="plots sent to the persistent R worker at a time")
+
+def plot_pixels(pxarray):
+    """(rgb, roi) of a clipped plot: uint8 RGB pixels and the plot polygon as the gift.R ROI."""
+    # pixels outside the plot polygon are nodata; fill them from the plot so the edge
+    # detection does not see the polygon border
+    rgb = numpy.rollaxis(pxarray[:3], 0, 3)
+    roi = (rgb != CLIP_NODATA).all(axis=2)
+    return gift_features.fill_outside(numpy.clip(rgb, 0, 255).astype(numpy.uint8), roi), roi
 
 class gift(TerrarefExtractor):
     def __init__(self):
@@ -43,6 +72,12 @@ class gift(TerrarefExtractor):
         # assign other argumentse
         self.bety_url = self.args.bety_url
         self.bety_key = self.args.bety_key
+        self.plot_workers = int(self.args.plot_workers)
+        self.plot_cache = plot_cache.PlotCache(self.args.plot_cache, self.args.plot_cache_ttl,
+                                               self.args.plot_cache_arrays)
+        self.texture_engine = self.args.texture_engine
+        self.r_batch = max(1, int(self.args.r_batch))
+        self.r_worker = gift_worker.GiftWorker() if self.texture_engine == 'r-worker' else None
 
     def check_message(self, connector, host, secret_key, resource, parameters):
         if resource['name'].find('fullfield') > -1 and resource['name'].find('thumb.tif') == -1:
@@ -52,72 +87,163 @@ class gift(TerrarefExtractor):
 
     def process_message(self, connector, host, secret_key, resource, parameters):
         self.start_message()
+        timer = stage_timer.StageTimer(self.extractor_info['name'], resource['id'])
 
         # Get full list of experiment plots using date as filter
         ds_info = get_info(connector, host, secret_key, resource['parent']['id'])
         timestamp = ds_info['name'].split(" - ")[1]
-        all_plots = get_site_boundaries(timestamp, city='Maricopa')
-
-        successful_plots = 0
-        for plotname in all_plots:
-            bounds = all_plots[plotname]
-
-            # Use GeoJSON string to clip full field to this plot
+        with timer.stage('plot_boundaries'):
+            all_plots = self.plot_cache.site_boundaries(timestamp, city='Maricopa')
+
+        # The per-plot clips and texture runs are independent; run them on a thread pool
+        # (the work is in GDAL, numpy and R, largely outside the GIL) and merge back in plot order.
+        # Each clip opens the mosaic read-only itself, since a GDAL dataset must not be shared between threads
+        plotnames = sorted(all_plots)
+        workdir = tempfile.mkdtemp()
+        try:
+            def features(job):
+                return self.process_plot(resource['local_paths'][0], workdir, timer, *job)
+            jobs = [(index, plotname, all_plots[plotname]) for index, plotname in enumerate(plotnames)]
+
+            pool = None
+            if self.plot_workers > 1 and len(jobs) > 1:
+                pool = ThreadPool(min(self.plot_workers, len(jobs)))
+            pool_map = pool.map if pool else lambda func, items: [func(item) for item in items]
             try:
-                (pxarray, geotrans) = clip_raster(resource['local_paths'][0], bounds)
-                if len(pxarray.shape) < 3:
-                    logging.error("unexpected array shape for %s (%s)" % (plotname, pxarray.shape))
+                if self.r_worker:
+                    results = []
+                    for start in range(0, len(jobs), self.r_batch):
+                        results += self.process_plot_batch(resource['local_paths'][0], workdir, timer,
+                                                           jobs[start:start+self.r_batch], pool_map)
+                else:
+                    results = pool_map(features, jobs)
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+
+            datapoints = geostreams_batch.DatapointBatch(connector, host, secret_key, "Canopy Cover",
+                                                         self.args.geostreams_workers, self.args.geostreams_batch)
+            successful_plots = 0
+            for plotname, result in zip(plotnames, results):
+                if result is None:
                     continue
-
-                plot_img = create_image(pxarray, "plot_image.png")
-                plot_csv = "plot.csv"
-                self.generate_table_only(plot_img, plot_csv)
-                trait_vals = self.extract_vals_from_csv(plot_csv)
-
+                bounds = all_plots[plotname]
+                trait_vals, plot_csv = result
                 successful_plots += 1
                 if successful_plots % 10 == 0:
                     logging.info("processed %s/%s plots successfully" % (successful_plots, len(all_plots)))
-            except:
-                logging.error("error generating traits for %s" % plotname)
-                continue
 
-            # Create BETY-ready CSV
-            (fields, traits) = self.get_traits_table()
-            for tr in trait_vals:
-                traits[tr] = str(trait_vals[tr])
-            traits['site'] = plotname
-            traits['local_datetime'] = timestamp+"T12-00-00-000"
-            trait_list = self.generate_traits_list(traits)
-            self.generate_cc_csv(plot_csv, fields, trait_list)
-
-            # submit CSV to BETY
-            submit_traits(plot_csv, self.bety_key)
-
-            # Prepare and submit datapoint
-            centroid_lonlat = json.loads(centroid_from_geojson(bounds))["coordinates"]
-            time_fmt = timestamp+"T12:00:00-07:00"
-            dpmetadata = {
-                "source": host+"files/"+resource['id'],
-            }
-            for tr in trait_vals:
-                dpmetadata[tr] = str(trait_vals[tr])
-            create_datapoint_with_dependencies(connector, host, secret_key, "Canopy Cover",
-                                               (centroid_lonlat[1], centroid_lonlat[0]), time_fmt, time_fmt,
-                                               dpmetadata, timestamp)
-
-            os.remove(plot_img)
-            os.remove(plot_csv)
+                # Create BETY-ready CSV
+                (fields, traits) = self.get_traits_table()
+                for tr in trait_vals:
+                    traits[tr] = str(trait_vals[tr])
+                traits['site'] = plotname
+                traits['local_datetime'] = timestamp+"T12-00-00-000"
+                trait_list = self.generate_traits_list(traits)
+                self.generate_cc_csv(plot_csv, fields, trait_list)
+
+                # submit CSV to BETY
+                with timer.stage('bety_submit', os.path.getsize(plot_csv)):
+                    submit_traits(plot_csv, self.bety_key)
+
+                # Prepare datapoint; they are submitted together below
+                centroid_lonlat = json.loads(centroid_from_geojson(bounds))["coordinates"]
+                time_fmt = timestamp+"T12:00:00-07:00"
+                dpmetadata = {
+                    "source": host+"files/"+resource['id'],
+                }
+                for tr in trait_vals:
+                    dpmetadata[tr] = str(trait_vals[tr])
+                datapoints.add((centroid_lonlat[1], centroid_lonlat[0]), time_fmt, time_fmt, dpmetadata, timestamp)
+
+                os.remove(plot_csv)
+        finally:
+            shutil.rmtree(workdir)
+            if self.r_worker:
+                # R is started again on the next message's first batch rather than left idle between messages
+                self.r_worker.close()
+
+        with timer.stage('geostreams'):
+            datapoints.flush()
 
         # Add metadata to original dataset indicating this was run
         ext_meta = build_metadata(host, self.extractor_info, resource['parent']['id'], {
             "plots_processed": successful_plots,
-            "plots_skipped": len(all_plots)-successful_plots
+            "plots_skipped": len(all_plots)-successful_plots,
             # TODO: add link to BETY trait IDs
+            "stage_timings": timer.summary(pending=['metadata_post'])
         }, 'dataset')
-        upload_metadata(connector, host, secret_key, resource['parent']['id'], ext_meta)
+        with timer.stage('metadata_post'):
+            upload_metadata(connector, host, secret_key, resource['parent']['id'], ext_meta)
 
+        timer.write(self.args.timing_log)
         self.end_message()
 
+    def process_plot(self, rast_path, workdir, timer, index, plotname, bounds):
+        """Clip one plot and compute its texture table; returns (trait values, CSV path) or None."""
+        # Use GeoJSON string to clip full field to this plot
+        try:
+            with timer.stage('clip') as st:
+                (pxarray, geotrans) = clip_raster(rast_path, bounds, nodata=CLIP_NODATA)
+                st.bytes += pxarray.nbytes
+            if len(pxarray.shape) < 3:
+                logging.error("unexpected array shape for %s (%s)" % (plotname, pxarray.shape))
+                return None
+
+            plot_csv = os.path.join(workdir, "plot_%04d.csv" % index)
+            if self.texture_engine == 'numpy':
+                with timer.stage('texture_features'):
+                    columns, rows = gift_features.feature_table(*plot_pixels(pxarray))
+                    gift_features.write_table(plot_csv, columns, rows)
+            else:
+                with timer.stage('plot_image') as st:
+                    plot_img = create_image(pxarray, os.path.join(workdir, "plot_image_%04d.png" % index))
+                    st.bytes += os.path.getsize(plot_img)
+                with timer.stage('texture_features'):
+                    self.generate_table_only(plot_img, plot_csv)
+                os.remove(plot_img)
+            trait_vals = self.extract_vals_from_csv(plot_csv)
+        except:
+            logging.error("error generating traits for %s" % plotname)
+            return None
+
+        return (trait_vals, plot_csv)
+
+    def process_plot_batch(self, rast_path, workdir, timer, jobs, pool_map):
+        """Clip a batch of plots and compute their texture tables in the persistent R worker."""
+        def clip(job):
+            index, plotname, bounds = job
+            try:
+                with timer.stage('clip') as st:
+                    (pxarray, geotrans) = clip_raster(rast_path, bounds, nodata=CLIP_NODATA)
+                    st.bytes += pxarray.nbytes
+                if len(pxarray.shape) < 3:
+                    logging.error("unexpected array shape for %s (%s)" % (plotname, pxarray.shape))
+                    return None
+                return plot_pixels(pxarray)
+            except:
+                logging.error("error clipping %s" % plotname)
+                return None
+
+        clipped = [(job, pixels) for job, pixels in zip(jobs, pool_map(clip, jobs)) if pixels is not None]
+        try:
+            with timer.stage('texture_features', sum(rgb.nbytes for _, (rgb, roi) in clipped)):
+                tables = self.r_worker.tables([pixels for _, pixels in clipped])
+        except:
+            logging.exception("R worker failed on plots %s" % ", ".join(job[1] for job, _ in clipped))
+            return [None]*len(jobs)
+
+        results = {}
+        for ((index, plotname, bounds), _), table in zip(clipped, tables):
+            if table is None:
+                logging.error("error generating traits for %s" % plotname)
+                continue
+            plot_csv = os.path.join(workdir, "plot_%04d.csv" % index)
+            gift_features.write_table(plot_csv, *table)
+            results[index] = (self.extract_vals_from_csv(plot_csv), plot_csv)
+        return [results.get(job[0]) for job in jobs]
+
     def generate_all_outputs(self, input_image, out_csv, out_dgci, out_edge, out_label, gps_bounds):
         # Generate actual output CSV and PNGs
         cmd = "Rscript gift.R -f %s " % input_image